@@ -11,6 +11,7 @@ import psycopg2
 from decimal import Decimal
 import json
 import os
+import numpy as np
 
 # Configuração da página
 st.set_page_config(
@@ -89,6 +90,38 @@ def calcular_viagens_e_caminhoes(amount_allocated, distance_km, capacidade_colhe
         'sacas_por_viagem': CAPACIDADE_CAMINHAO
     }
 
+def calcular_viagens_e_caminhoes_colunas(amount_allocated, distance_km):
+    """
+    Versão vetorizada de calcular_viagens_e_caminhoes: recebe as colunas inteiras
+    (Series) e calcula tudo com NumPy, sem laço por linha
+    
+    Returns:
+        DataFrame com os cálculos de logística, no mesmo índice das colunas
+    """
+    sacas = amount_allocated.to_numpy(dtype=float)
+    distancias = distance_km.to_numpy(dtype=float)
+    
+    viagens_necessarias = np.ceil(sacas / CAPACIDADE_CAMINHAO).astype(np.int64)
+    tempo_viagem_horas = (distancias * 2 / VELOCIDADE_MEDIA) + TEMPO_CARGA_DESCARGA
+    viagens_por_dia_caminhao = np.maximum(1, np.floor(HORAS_TRABALHO_DIA / tempo_viagem_horas)).astype(np.int64)
+    caminhoes_necessarios = np.ceil(viagens_necessarias / viagens_por_dia_caminhao).astype(np.int64)
+    dias_operacao = calcular_dias_operacao(viagens_necessarias, caminhoes_necessarios, viagens_por_dia_caminhao)
+    
+    return pd.DataFrame({
+        'viagens_necessarias': viagens_necessarias,
+        'tempo_viagem_horas': np.round(tempo_viagem_horas, 2),
+        'viagens_por_dia_caminhao': viagens_por_dia_caminhao,
+        'caminhoes_necessarios': caminhoes_necessarios,
+        'dias_operacao': dias_operacao,
+        'sacas_por_viagem': CAPACIDADE_CAMINHAO
+    }, index=amount_allocated.index)
+
+def calcular_dias_operacao(viagens_necessarias, caminhoes, viagens_por_dia_caminhao):
+    """Dias para completar o transporte de cada carga (0 quando não há caminhões)"""
+    capacidade_dia = caminhoes * viagens_por_dia_caminhao
+    dias = np.ceil(viagens_necessarias / np.maximum(capacidade_dia, 1))
+    return np.where(capacidade_dia > 0, dias, 0).astype(np.int64)
+
 @st.cache_data
 def conectar_banco_dados():
     """
@@ -150,27 +183,28 @@ def processar_dados_logistica(df):
     # Carregar ajustes manuais
     ajustes = carregar_ajustes_caminhoes()
     
-    # Aplicar cálculos de logística para cada linha
-    resultados = []
-    for _, row in df.iterrows():
-        calc = calcular_viagens_e_caminhoes(row['amount_allocated'], row['distance'])
-        
-        # Verificar se há ajuste manual para este ID
-        id_str = str(row['id'])
-        if id_str in ajustes:
-            calc['caminhoes_necessarios'] = ajustes[id_str]['caminhoes_manual']
-            calc['ajuste_manual'] = True
-            calc['caminhoes_calculado'] = calc['caminhoes_necessarios']  # Backup do cálculo original
-            # Recalcular dias com o número manual de caminhões
-            calc['dias_operacao'] = math.ceil(calc['viagens_necessarias'] / (ajustes[id_str]['caminhoes_manual'] * calc['viagens_por_dia_caminhao']))
-        else:
-            calc['ajuste_manual'] = False
-            calc['caminhoes_calculado'] = calc['caminhoes_necessarios']
-        
-        resultados.append(calc)
+    # Cálculos de logística sobre as colunas inteiras
+    calc_df = calcular_viagens_e_caminhoes_colunas(df['amount_allocated'], df['distance'])
+    
+    # Ajustes manuais alinhados às cargas por ID (join vetorizado)
+    ajustes_df = pd.DataFrame.from_dict(ajustes, orient='index', columns=['caminhoes_manual'])
+    ajuste = ajustes_df.reindex(df['id'].astype(str).to_numpy())
+    manual = ajuste['caminhoes_manual'].notna().to_numpy()
+    
+    if manual.any():
+        caminhoes_manual = ajuste['caminhoes_manual'].fillna(0).to_numpy(dtype=np.int64)
+        calc_df['caminhoes_necessarios'] = np.where(manual, caminhoes_manual, calc_df['caminhoes_necessarios'])
+        # Recalcular dias com o número manual de caminhões
+        calc_df['dias_operacao'] = np.where(
+            manual,
+            calcular_dias_operacao(calc_df['viagens_necessarias'].to_numpy(), caminhoes_manual,
+                                   calc_df['viagens_por_dia_caminhao'].to_numpy()),
+            calc_df['dias_operacao']
+        )
+    calc_df['ajuste_manual'] = manual
+    calc_df['caminhoes_calculado'] = calc_df['caminhoes_necessarios']
     
     # Adicionar colunas calculadas ao DataFrame
-    calc_df = pd.DataFrame(resultados)
     df_final = pd.concat([df, calc_df], axis=1)
     
     # Adicionar cálculos adicionais
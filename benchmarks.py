@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks dos módulos de sincronização e provisionamento
+
+Uso: python benchmarks.py [nome]
+"""
+
+import os
+import random
+import sys
+import time
+
+from bson import ObjectId
+
+from sync_combinations import SyncCombinations, SaleOrder, PurchaseOrder
+import psycopg2
+
+from provisionings_min_distance import ProvisioningMinDistance
+from provisionings_min_cost_flow import ProvisioningMinCostFlow
+
+GRAINS = [ObjectId('5e349bed3b0fd74ea91f1488'), ObjectId('5e349c053b0fd74ea91f148a')]
+
+
+def synthetic_orders(n_sales=600, n_purchases=1500, seed=42):
+    """Gera vendas e compras sintéticas distribuídas entre dois grãos"""
+    rng = random.Random(seed)
+
+    def new_id():
+        return ObjectId('%024x' % rng.getrandbits(96))
+
+    addresses = [new_id() for _ in range(200)]
+
+    sales = [SaleOrder(
+        id=new_id(),
+        grain=rng.choice(GRAINS),
+        bag_price=rng.uniform(50, 80),
+        amount=rng.randint(500, 20000),
+        has_pis=rng.random() < 0.5,
+        buyer_name=f"Comprador {i % 40}",
+        to_id=rng.choice(addresses),
+        to_coords=[rng.uniform(-55, -45), rng.uniform(-20, -10)],
+        amount_provisioned=rng.randint(500, 20000)
+    ) for i in range(n_sales)]
+
+    purchases = [PurchaseOrder(
+        id=new_id(),
+        grain=rng.choice(GRAINS),
+        bag_price=rng.uniform(35, 60),
+        amount=rng.randint(500, 20000),
+        has_pis=rng.random() < 0.5,
+        seller_name=f"Vendedor {i % 80}",
+        from_id=rng.choice(addresses),
+        from_coords=[rng.uniform(-55, -45), rng.uniform(-20, -10)]
+    ) for i in range(n_purchases)]
+
+    distances_map = {
+        (frm, to): rng.uniform(5, 900)
+        for frm in addresses for to in addresses
+    }
+    return sales, purchases, distances_map
+
+
+def synthetic_combinations(n_sales=80, n_purchases=200, seed=42):
+    """Gera os documentos de combinação ordenados por distância, como lidos do MongoDB"""
+    sales, purchases, distances_map = synthetic_orders(n_sales, n_purchases, seed)
+    sync = SyncCombinations()
+    docs = list(sync.iter_docs(sync.group_by_grain(sales, purchases), distances_map))
+    docs.sort(key=lambda d: d['distance'])
+    return docs
+
+
+def bench_grain_buckets():
+    """Compara pares visitados: varredura completa vendas × compras vs join por grão"""
+    sales, purchases, _ = synthetic_orders()
+    sync = SyncCombinations()
+
+    start = time.perf_counter()
+    full_scan = sum(
+        1 for sale in sales for pur in purchases if sale.grain == pur.grain
+    )
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buckets = sync.group_by_grain(sales, purchases)
+    bucketed = sum(1 for _ in sync.iter_pairs(buckets))
+    bucket_time = time.perf_counter() - start
+
+    print(f"Vendas: {len(sales)} | Compras: {len(purchases)} | Grãos: {len(GRAINS)}")
+    print(f"Varredura completa: {len(sales) * len(purchases)} pares visitados, "
+          f"{full_scan} válidos, {full_time:.3f}s")
+    print(f"Join por grão:      {sync.stats['pairs_visited']} pares visitados, "
+          f"{bucketed} válidos, {bucket_time:.3f}s")
+
+
+def bench_parallel_generation():
+    """Speedup da geração de combinações por número de processos (sem gravar no MongoDB)"""
+    sales, purchases, distances_map = synthetic_orders(n_sales=1500, n_purchases=3000)
+    serial = SyncCombinations()
+    buckets = serial.group_by_grain(sales, purchases)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in serial.iter_docs(buckets, distances_map))
+    base = time.perf_counter() - start
+    print(f"1 processo:  {count} combinações em {base:.2f}s")
+
+    workers = 2
+    while workers <= (os.cpu_count() or 1):
+        sync = SyncCombinations(parallel_workers=workers)
+        start = time.perf_counter()
+        count, _ = sync.generate_parallel(buckets, distances_map, dry_run=True)
+        elapsed = time.perf_counter() - start
+        print(f"{workers} processos: {count} combinações em {elapsed:.2f}s (speedup {base / elapsed:.2f}x)")
+        workers *= 2
+
+
+def bench_min_cost_flow():
+    """Tempo e qualidade do fluxo de custo mínimo vs guloso por distância"""
+    docs = synthetic_combinations()
+    print(f"Combinações: {len(docs)}")
+
+    def flow_rows(provisioning):
+        return [row for net in provisioning.load_networks(docs) for row in provisioning.solve_network(net)]
+
+    runs = [
+        ('guloso (distância)', ProvisioningMinDistance(), lambda p: p.process_allocations(docs)),
+        ('fluxo (distance)', ProvisioningMinCostFlow(objective='distance'), flow_rows),
+        ('fluxo (profit)', ProvisioningMinCostFlow(objective='profit'), flow_rows),
+    ]
+    for label, provisioning, allocate in runs:
+        provisioning.stats['total_combinations'] = len(docs)
+        start = time.perf_counter()
+        rows = allocate(provisioning)
+        elapsed = time.perf_counter() - start
+        provisioning.summarize_rows(rows)
+        km = sum(row[5] * row[11] for row in rows)
+        print(f"{label:<20} {elapsed:7.2f}s | {provisioning.stats['total_allocated']:>10,} sacas | "
+              f"{km:>14,.0f} saca·km | lucro R$ {provisioning.stats['total_profit']:>14,.2f}")
+
+
+class BenchScenario(ProvisioningMinDistance):
+    """Provisionamento que grava numa tabela descartável de benchmark"""
+    table_name = 'provisioningsv2_bench_scenario'
+
+
+def bench_pg_write():
+    """Gravação do cenário: COPY FROM STDIN vs INSERT com execute_values (requer BENCH_PG_DSN)"""
+    dsn = os.environ.get('BENCH_PG_DSN')
+    if not dsn:
+        print("Defina BENCH_PG_DSN com um PostgreSQL descartável para rodar este benchmark")
+        return
+
+    provisioning = BenchScenario(keep_history=False)
+    rows = provisioning.process_allocations(synthetic_combinations())
+    # Réplicas com destinos distintos: o cenário tem uma linha por par destino/origem
+    rows = [
+        (f"{row[0]}-{copy}",) + row[1:]
+        for copy in range(100000 // len(rows) + 1)
+        for row in rows
+    ]
+
+    provisioning.pg_conn = psycopg2.connect(dsn)
+    try:
+        for method in ('values', 'copy'):
+            provisioning.config['pg_write_method'] = method
+            provisioning.prepare_postgresql_table()
+            start = time.perf_counter()
+            provisioning.save_to_postgresql(rows)
+            elapsed = time.perf_counter() - start
+            print(f"{method:<7} {len(rows)} linhas em {elapsed:.2f}s ({len(rows) / elapsed:,.0f} linhas/s)")
+    finally:
+        cursor = provisioning.pg_conn.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {provisioning.table_name}")
+        cursor.execute("DELETE FROM provisioningsv2_schema_migrations WHERE table_name = %s",
+                       (provisioning.table_name,))
+        provisioning.pg_conn.commit()
+        provisioning.pg_conn.close()
+
+
+BENCHMARKS = {
+    'grain_buckets': bench_grain_buckets,
+    'parallel_generation': bench_parallel_generation,
+    'min_cost_flow': bench_min_cost_flow,
+    'pg_write': bench_pg_write,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"=== {name} ===")
+        BENCHMARKS[name]()
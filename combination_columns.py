@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Representação colunar compacta das combinações para o provisionamento
+"""
+
+from array import array
+
+
+class CombinationColumns:
+    """
+    Combinações em arrays paralelos tipados.
+
+    Pedidos, compradores, vendedores e grãos são internados como inteiros. Os
+    atributos de cada destino e origem (preço, saldo, impostos, coordenadas)
+    ficam uma única vez em tabelas próprias. Por combinação restam só os
+    índices de destino e origem (int32) e distância, frete e lucro (float64).
+    """
+
+    def __init__(self):
+        self.names = []
+        self.name_index = {}
+        self.grains = []
+        self.grain_index = {}
+
+        # Destinos (vendas)
+        self.dest_ids = []
+        self.dest_index = {}
+        self.dest_grain = array('i')
+        self.dest_buyer = array('i')
+        self.dest_amount = array('d')
+        self.dest_price = array('d')
+        self.dest_tax = array('d')
+        self.dest_coords = []
+
+        # Origens (compras)
+        self.orig_ids = []
+        self.orig_index = {}
+        self.orig_grain = array('i')
+        self.orig_seller = array('i')
+        self.orig_amount = array('d')
+        self.orig_price = array('d')
+        self.orig_credit = array('d')
+        self.orig_coords = []
+
+        # Combinações, na ordem de leitura
+        self.dest = array('i')
+        self.orig = array('i')
+        self.distance = array('d')
+        self.freight = array('d')
+        self.profit = array('d')
+
+    def _intern(self, values, index, value):
+        idx = index.get(value)
+        if idx is None:
+            idx = index[value] = len(values)
+            values.append(value)
+        return idx
+
+    def add(self, comb):
+        """Acrescenta uma combinação, registrando destino e origem na primeira ocorrência"""
+        dest_key = comb['destinationOrder']
+        d = self.dest_index.get(dest_key)
+        if d is None:
+            d = self.dest_index[dest_key] = len(self.dest_ids)
+            self.dest_ids.append(dest_key)
+            self.dest_grain.append(self._intern(self.grains, self.grain_index, comb.get('grain')))
+            self.dest_buyer.append(self._intern(self.names, self.name_index, comb.get('buyer')))
+            self.dest_amount.append(comb.get('amountProvisionedOriginal', comb['amountDestination']))
+            self.dest_price.append(comb['destinationPrice'])
+            self.dest_tax.append(comb['destinationTax'])
+            self.dest_coords.append(comb.get('to_coords', [None, None]))
+
+        orig_key = comb['originOrder']
+        o = self.orig_index.get(orig_key)
+        if o is None:
+            o = self.orig_index[orig_key] = len(self.orig_ids)
+            self.orig_ids.append(orig_key)
+            self.orig_grain.append(self._intern(self.grains, self.grain_index, comb.get('grain')))
+            self.orig_seller.append(self._intern(self.names, self.name_index, comb.get('seller')))
+            self.orig_amount.append(comb['amountOrigin'])
+            self.orig_price.append(comb['originPrice'])
+            self.orig_credit.append(comb['originCredit'])
+            self.orig_coords.append(comb.get('from_coords', [None, None]))
+
+        self.dest.append(d)
+        self.orig.append(o)
+        self.distance.append(comb.get('distance', 0))
+        self.freight.append(comb['freightCost'])
+        self.profit.append(comb['profit'])
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        """Converte as combinações de um cursor sem manter os documentos na memória"""
+        columns = cls()
+        for comb in cursor:
+            columns.add(comb)
+        return columns
+
+    def __len__(self):
+        return len(self.dest)
+
+    def nbytes(self):
+        """Bytes ocupados pelos arrays indexados por combinação"""
+        return sum(
+            col.itemsize * len(col)
+            for col in (self.dest, self.orig, self.distance, self.freight, self.profit)
+        )
+
+    def orders_by_grain(self, grains_of):
+        """Conta destinos ou origens por grão interno"""
+        counts = {}
+        for grain in grains_of:
+            counts[grain] = counts.get(grain, 0) + 1
+        return counts
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache local de distâncias em disco (memory-mapped), atualizado de forma incremental a partir do MongoDB
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+STORE_VERSION = 1
+
+# Janela relida antes da marca d'água a cada atualização: cobre rotas gravadas no mesmo
+# milissegundo da marca e relógios de clientes atrasados em relação ao servidor
+WATERMARK_MARGIN = timedelta(minutes=5)
+
+
+class DistanceStore:
+    """
+    Matriz esparsa de distâncias mapeada em memória.
+
+    Cada endereço é internado como um inteiro; uma rota é guardada como a chave
+    int64 (origem << 32 | destino), formada pelos dois índices int32, mais a
+    distância em float32. As chaves ficam ordenadas para busca binária.
+
+    Leituras e gravações do diretório passam por um flock em .lock: load usa o
+    lock compartilhado e refresh o exclusivo, então processos (e threads) que
+    atualizam o cache ao mesmo tempo se serializam e nunca removem uma geração
+    que outro está carregando.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = []
+        self.index = {}
+        self.keys = np.empty(0, dtype=np.int64)
+        self.km = np.empty(0, dtype=np.float32)
+        self.watermark = None
+        self.generation = 0
+        self.overlay = {}
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, f"{name}-{generation}")
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        """flock no arquivo .lock do diretório do cache"""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        """Mapeia em memória a última geração gravada em disco, se existir"""
+        with self.lock():
+            return self._load()
+
+    def _load(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            return False
+
+        gen = meta['generation']
+        with open(self._file('ids', gen) + '.json', encoding='utf-8') as f:
+            self.ids = json.load(f)
+        self.index = {addr: i for i, addr in enumerate(self.ids)}
+        self.keys = np.load(self._file('keys', gen) + '.npy', mmap_mode='r')
+        self.km = np.load(self._file('km', gen) + '.npy', mmap_mode='r')
+        self.watermark = meta.get('watermark')
+        self.generation = gen
+        return True
+
+    def intern(self, address_id):
+        """Retorna o índice inteiro do endereço, criando-o se necessário"""
+        key = str(address_id)
+        idx = self.index.get(key)
+        if idx is None:
+            idx = len(self.ids)
+            self.ids.append(key)
+            self.index[key] = idx
+        return idx
+
+    def refresh(self, collection):
+        """Traz do MongoDB apenas as rotas alteradas desde a última atualização"""
+        with self.lock(exclusive=True):
+            # Outro processo pode ter publicado uma geração mais nova desde o load
+            self._load()
+            return self._refresh(collection)
+
+    def _refresh(self, collection):
+        query = {}
+        if self.watermark:
+            query = {'updatedAt': {'$gte': datetime.fromisoformat(self.watermark) - WATERMARK_MARGIN}}
+        cursor = collection.find(query, {'from': 1, 'to': 1, 'inKm': 1, 'updatedAt': 1})
+
+        new_keys, new_km = [], []
+        watermark = self.watermark
+        for d in cursor:
+            updated = d.get('updatedAt')
+            if updated is not None:
+                updated = updated.isoformat()
+                if watermark is None or updated > watermark:
+                    watermark = updated
+
+            # A janela relê rotas já guardadas: só entram as novas ou com distância alterada
+            km = np.float32(d.get('inKm') or 0)
+            if self._stored((d['from'], d['to'])) == km:
+                continue
+            frm, to = self.intern(d['from']), self.intern(d['to'])
+            new_keys.append((frm << 32) | to)
+            new_km.append(km)
+
+        if not new_keys:
+            if watermark != self.watermark:
+                self.watermark = watermark
+                self.save()
+            return 0
+
+        # Concatena antigo + novo; na ordenação estável a última ocorrência de cada chave prevalece
+        all_keys = np.concatenate([self.keys, np.array(new_keys, dtype=np.int64)])
+        all_km = np.concatenate([self.km, np.array(new_km, dtype=np.float32)])
+        order = np.argsort(all_keys, kind='stable')
+        all_keys, all_km = all_keys[order], all_km[order]
+        last = np.append(all_keys[1:] != all_keys[:-1], True)
+
+        self.keys, self.km = all_keys[last], all_km[last]
+        self.watermark = watermark
+        self.save()
+        return len(new_keys)
+
+    def save(self):
+        """Grava uma nova geração em disco e a publica atomicamente via meta.json (sob o lock exclusivo)"""
+        os.makedirs(self.path, exist_ok=True)
+        gen = self.generation + 1
+
+        with open(self._file('ids', gen) + '.json', 'w', encoding='utf-8') as f:
+            json.dump(self.ids, f)
+        np.save(self._file('keys', gen) + '.npy', self.keys)
+        np.save(self._file('km', gen) + '.npy', self.km)
+
+        meta_tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(meta_tmp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': STORE_VERSION,
+                'generation': gen,
+                'watermark': self.watermark,
+                'routes': int(len(self.keys))
+            }, f)
+        os.replace(meta_tmp, os.path.join(self.path, 'meta.json'))
+
+        # Remove a geração anterior
+        for name, ext in (('ids', '.json'), ('keys', '.npy'), ('km', '.npy')):
+            old = self._file(name, self.generation) + ext
+            if os.path.exists(old):
+                os.remove(old)
+
+        self.generation = gen
+        self.keys = np.load(self._file('keys', gen) + '.npy', mmap_mode='r')
+        self.km = np.load(self._file('km', gen) + '.npy', mmap_mode='r')
+
+    def _stored(self, pair):
+        """Distância gravada em disco para o par, ou None"""
+        frm = self.index.get(str(pair[0]))
+        to = self.index.get(str(pair[1]))
+        if frm is None or to is None:
+            return None
+        key = (frm << 32) | to
+        pos = int(np.searchsorted(self.keys, key))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return self.km[pos]
+        return None
+
+    def get(self, pair, default=0):
+        """Distância em km do par (origem, destino), com a mesma interface de dict.get"""
+        if pair in self.overlay:
+            return self.overlay[pair]
+        km = self._stored(pair)
+        return default if km is None else float(km)
+
+    def __setitem__(self, pair, km):
+        # Distâncias resolvidas durante a execução; chegam ao disco na próxima atualização via updatedAt
+        self.overlay[pair] = km
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup_matrix(self, from_ids, to_ids):
+        """Retorna a matriz len(to_ids) × len(from_ids) de distâncias (0 quando ausente)"""
+        frm = np.array([self.index.get(str(a), -1) for a in from_ids], dtype=np.int64)
+        to = np.array([self.index.get(str(a), -1) for a in to_ids], dtype=np.int64)
+        keys = (frm[None, :] << 32) | to[:, None]
+
+        pos = np.searchsorted(self.keys, keys)
+        pos_ok = np.minimum(pos, max(len(self.keys) - 1, 0))
+        found = (frm[None, :] >= 0) & (to[:, None] >= 0) & (pos < len(self.keys))
+        if len(self.keys):
+            found &= self.keys[pos_ok] == keys
+        result = np.where(found, self.km[pos_ok] if len(self.keys) else 0, 0).astype(float)
+
+        if self.overlay:
+            cols, rows = {}, {}
+            for j, a in enumerate(from_ids):
+                cols.setdefault(a, []).append(j)
+            for i, b in enumerate(to_ids):
+                rows.setdefault(b, []).append(i)
+            for (a, b), km in self.overlay.items():
+                if a in cols and b in rows:
+                    result[np.ix_(rows[b], cols[a])] = km
+        return result
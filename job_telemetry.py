@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Progresso, status e logs dos jobs em background, compartilhados com o painel
+"""
+
+from collections import deque
+from datetime import datetime
+import copy
+import threading
+import time
+
+# Configurações da telemetria
+TELEMETRY_CONFIG = {
+    'max_logs': 2000,       # linhas mantidas no buffer circular de logs
+    'min_interval': 0.5,    # segundos mínimos entre publicações de progresso nos laços
+    'check_every': 1000     # iterações dos laços entre consultas ao relógio
+}
+
+
+class JobTelemetry:
+    """
+    Estado publicado por um job para leitura concorrente (threads do Streamlit).
+
+    O job escreve sob um lock e o painel lê cópias via snapshot(). Nos laços,
+    report_progress() só publica quando passou min_interval desde a última
+    publicação; checkpoints (set_progress, status) publicam sempre. As
+    estatísticas publicadas são cópias, nunca o dict que o job está alterando.
+    Os logs ficam só no buffer; echo=True também os imprime no stdout, o que
+    só faz sentido fora do processo do Streamlit (scripts e benchmarks).
+    """
+
+    def __init__(self, max_logs=None, min_interval=None, echo=False):
+        self.max_logs = max_logs or TELEMETRY_CONFIG['max_logs']
+        self.min_interval = TELEMETRY_CONFIG['min_interval'] if min_interval is None else min_interval
+        self.echo = echo
+        self._lock = threading.Lock()
+        self._status = "Não iniciado"
+        self._progress = 0
+        self._stats = {}
+        self._logs = deque(maxlen=self.max_logs)
+        self._published_at = 0.0
+
+    def reset(self, stats=None):
+        """Inicia uma nova execução: status Executando, progresso zerado e logs limpos"""
+        stats = copy.deepcopy(stats or {})
+        with self._lock:
+            self._status = "Executando"
+            self._progress = 0
+            self._stats = stats
+            self._logs.clear()
+            self._published_at = time.monotonic()
+
+    @property
+    def status(self):
+        with self._lock:
+            return self._status
+
+    @property
+    def progress(self):
+        with self._lock:
+            return self._progress
+
+    def set_status(self, status, stats=None):
+        """Publica o status e, se informadas, as estatísticas"""
+        stats = copy.deepcopy(stats) if stats is not None else None
+        with self._lock:
+            self._status = status
+            if stats is not None:
+                self._stats = stats
+
+    def set_progress(self, progress, stats=None):
+        """Publica o progresso de um checkpoint, sem limite de frequência"""
+        stats = copy.deepcopy(stats) if stats is not None else None
+        with self._lock:
+            self._progress = progress
+            if stats is not None:
+                self._stats = stats
+            self._published_at = time.monotonic()
+
+    def due(self):
+        """Indica se já passou o intervalo mínimo desde a última publicação"""
+        return time.monotonic() - self._published_at >= self.min_interval
+
+    def report_progress(self, progress, stats=None):
+        """Publica o progresso de um laço se o intervalo mínimo passou; retorna se publicou"""
+        if not self.due():
+            return False
+        self.set_progress(progress, stats)
+        return True
+
+    def log(self, message, level="INFO"):
+        """Adiciona log com timestamp ao buffer circular (e ao stdout, se echo)"""
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        log_entry = f"[{timestamp}] [{level}] {message}"
+        with self._lock:
+            self._logs.append(log_entry)
+        if self.echo:
+            print(log_entry)
+
+    def logs(self, last=None):
+        """Cópia das últimas linhas de log (todas, se last for None)"""
+        with self._lock:
+            entries = list(self._logs)
+        return entries[-last:] if last else entries
+
+    def snapshot(self):
+        """Cópia consistente de status, progresso, estatísticas e logs"""
+        with self._lock:
+            return {
+                'status': self._status,
+                'progress': self._progress,
+                'stats': copy.deepcopy(self._stats),
+                'logs': list(self._logs)
+            }
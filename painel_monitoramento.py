@@ -6,13 +6,16 @@ from datetime import datetime, timedelta
 import time
 import threading
 import psycopg2
+from pymongo import MongoClient
 import folium
 from streamlit_folium import st_folium
 import json
 
 # Importar módulos de processamento
-from sync_combinations import sync_combinations
-from provisionings_min_distance import provisioning_min_distance
+from sync_combinations import sync_combinations, load_pending_changes, MONGO_URI
+from provisionings_min_distance import get_provisioning_for_strategy, SCENARIO_ROWS_QUERY
+from provisionings_min_cost_flow import ProvisioningMinCostFlow, get_provisioning_min_cost_flow
+from provisioning_strategies import STRATEGIES
 
 # Configuração da página
 st.set_page_config(
@@ -81,6 +84,10 @@ DB_CONFIG = {
     'database': 'mydb'
 }
 
+# Opções de provisionamento: estratégias gulosas e o fluxo de custo mínimo (label e tabela do cenário)
+FLUXO_CUSTO_MINIMO = 'min_cost_flow'
+OPCOES_PROVISIONAMENTO = {**STRATEGIES, FLUXO_CUSTO_MINIMO: ProvisioningMinCostFlow}
+
 def conectar_banco():
     """Conecta ao banco de dados PostgreSQL"""
     try:
@@ -89,12 +96,12 @@ def conectar_banco():
         st.error(f"Erro ao conectar com o banco: {e}")
         return None
 
-def carregar_dados_provisionamento():
-    """Carrega dados da tabela de provisionamento"""
+def carregar_dados_provisionamento(table_name='provisioningsv2_best_scenario_distance'):
+    """Carrega dados da tabela de provisionamento da estratégia"""
     try:
         conn = conectar_banco()
         if conn:
-            query = """
+            query = f"""
             SELECT 
                 buyer,
                 seller,
@@ -107,7 +114,7 @@ def carregar_dados_provisionamento():
                 distance,
                 from_coords,
                 to_coords
-            FROM provisioningsv2_best_scenario_distance
+            FROM {table_name}
             ORDER BY distance ASC
             """
             df = pd.read_sql(query, conn)
@@ -118,6 +125,91 @@ def carregar_dados_provisionamento():
         st.error(f"Erro ao carregar dados: {e}")
         return pd.DataFrame()
 
+def listar_cenarios(table_name):
+    """Lista os cenários do histórico gerados para a tabela da estratégia"""
+    try:
+        conn = conectar_banco()
+        if conn:
+            query = """
+            SELECT 
+                scenario_id,
+                strategy,
+                created_at,
+                row_count,
+                total_allocated,
+                total_profit,
+                average_distance
+            FROM provisioningsv2_scenarios
+            WHERE table_name = %(table_name)s
+            ORDER BY scenario_id DESC
+            """
+            df = pd.read_sql(query, conn, params={'table_name': table_name})
+            conn.close()
+            return df
+        return pd.DataFrame()
+    except Exception as e:
+        st.error(f"Erro ao carregar histórico: {e}")
+        return pd.DataFrame()
+
+def carregar_cenario(scenario_id):
+    """Carrega as linhas de um cenário do histórico (remontado sobre os cenários base, se incremental)"""
+    try:
+        conn = conectar_banco()
+        if conn:
+            query = f"""
+            SELECT 
+                buyer,
+                seller,
+                grain,
+                amount_allocated,
+                revenue,
+                cost,
+                freight,
+                profit_total,
+                distance,
+                from_coords,
+                to_coords
+            FROM ({SCENARIO_ROWS_QUERY.format(param='scenario_id')}) r
+            ORDER BY distance ASC
+            """
+            df = pd.read_sql(query, conn, params={'scenario_id': int(scenario_id)})
+            conn.close()
+            return df
+        return pd.DataFrame()
+    except Exception as e:
+        st.error(f"Erro ao carregar cenário: {e}")
+        return pd.DataFrame()
+
+def comparar_cenarios(base_id, novo_id):
+    """Rotas cuja alocação mudou entre dois cenários do histórico"""
+    try:
+        conn = conectar_banco()
+        if conn:
+            query = f"""
+            SELECT 
+                COALESCE(b.buyer, n.buyer) AS buyer,
+                COALESCE(b.seller, n.seller) AS seller,
+                COALESCE(b.grain, n.grain) AS grain,
+                COALESCE(b.distance, n.distance) AS distance,
+                COALESCE(b.amount_allocated, 0) AS sacas_base,
+                COALESCE(n.amount_allocated, 0) AS sacas_novo,
+                COALESCE(n.amount_allocated, 0) - COALESCE(b.amount_allocated, 0) AS diferenca_sacas,
+                COALESCE(n.profit_total, 0) - COALESCE(b.profit_total, 0) AS diferenca_lucro
+            FROM ({SCENARIO_ROWS_QUERY.format(param='base_id')}) b
+            FULL OUTER JOIN ({SCENARIO_ROWS_QUERY.format(param='novo_id')}) n
+              ON b.destination_order = n.destination_order
+             AND b.origin_order = n.origin_order
+            WHERE b.amount_allocated IS DISTINCT FROM n.amount_allocated
+            ORDER BY ABS(COALESCE(n.amount_allocated, 0) - COALESCE(b.amount_allocated, 0)) DESC
+            """
+            df = pd.read_sql(query, conn, params={'base_id': int(base_id), 'novo_id': int(novo_id)})
+            conn.close()
+            return df
+        return pd.DataFrame()
+    except Exception as e:
+        st.error(f"Erro ao comparar cenários: {e}")
+        return pd.DataFrame()
+
 def executar_sync_combinations():
     """Executa sincronização em thread separada"""
     def run():
@@ -127,10 +219,47 @@ def executar_sync_combinations():
     thread.daemon = True
     thread.start()
 
-def executar_provisioning():
+def obter_provisionador(estrategia):
+    """Provisionador da estratégia: cada estratégia tem a sua instância, criada só quando escolhida"""
+    if estrategia == FLUXO_CUSTO_MINIMO:
+        return get_provisioning_min_cost_flow()
+    return get_provisioning_for_strategy(estrategia)
+
+def executar_provisioning(estrategia):
     """Executa provisionamento em thread separada"""
+    provisionador = obter_provisionador(estrategia)
+    
+    def run():
+        provisionador.run_provisioning()
+    
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+@st.cache_resource
+def cliente_mongo():
+    """Cliente MongoDB compartilhado pelas reexecuções do painel"""
+    return MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+
+@st.cache_data(ttl=30)
+def carregar_alteracoes_pendentes(table_name, status):
+    """
+    Ordens pendentes de reprovisionamento na tabela de cenário. A leitura fica em cache
+    para não consultar o MongoDB a cada atualização automática; o status do provisionador
+    entra na chave para que o fim de uma execução recarregue as pendências. Uma falha
+    também fica em cache e devolve None.
+    """
+    try:
+        return load_pending_changes(cliente_mongo()['fox'], table_name)
+    except Exception:
+        return None
+
+def executar_provisioning_incremental(estrategia):
+    """Reprovisiona em thread separada só as ordens pendentes desde o último provisionamento"""
+    provisionador = obter_provisionador(estrategia)
+    
     def run():
-        provisioning_min_distance.run_provisioning()
+        provisionador.run_incremental()
     
     thread = threading.Thread(target=run)
     thread.daemon = True
@@ -146,11 +275,12 @@ if st.sidebar.button("▶️ Executar Sincronização", key="sync_btn"):
     executar_sync_combinations()
     st.sidebar.success("Sincronização iniciada!")
 
-# Status da sincronização
-sync_status = sync_combinations.status
+# Status da sincronização (cópia consistente do estado publicado pela thread do job)
+sync_snap = sync_combinations.telemetry.snapshot()
+sync_status = sync_snap['status']
 if sync_status == "Executando":
     st.sidebar.markdown(f'<p class="status-running">Status: {sync_status}</p>', unsafe_allow_html=True)
-    st.sidebar.progress(sync_combinations.progress / 100)
+    st.sidebar.progress(sync_snap['progress'] / 100)
 elif sync_status == "Erro":
     st.sidebar.markdown(f'<p class="status-error">Status: {sync_status}</p>', unsafe_allow_html=True)
 elif sync_status == "Concluído":
@@ -159,17 +289,42 @@ else:
     st.sidebar.write(f"Status: {sync_status}")
 
 # Seção de Provisionamento
-st.sidebar.subheader("📦 Provisionamento por Distância")
+st.sidebar.subheader("📦 Provisionamento")
+
+estrategia = st.sidebar.selectbox(
+    "Estratégia",
+    list(OPCOES_PROVISIONAMENTO),
+    format_func=lambda name: OPCOES_PROVISIONAMENTO[name].label.capitalize(),
+    key="prov_strategy"
+)
+tabela_cenario = OPCOES_PROVISIONAMENTO[estrategia].table_name
 
-if st.sidebar.button("▶️ Executar Provisionamento", key="prov_btn"):
-    executar_provisioning()
+# Enquanto a estratégia executa, novas execuções sobre a mesma tabela ficam bloqueadas
+prov_snap = obter_provisionador(estrategia).telemetry.snapshot()
+prov_status = prov_snap['status']
+em_execucao = prov_status == "Executando"
+
+if st.sidebar.button("▶️ Executar Provisionamento", key="prov_btn", disabled=em_execucao):
+    executar_provisioning(estrategia)
     st.sidebar.success("Provisionamento iniciado!")
 
+# Com alterações pendentes de sincronizações incrementais, basta refazer o componente das ordens alteradas
+pendentes = carregar_alteracoes_pendentes(tabela_cenario, prov_status)
+if pendentes is None:
+    st.sidebar.warning("Erro ao carregar alterações pendentes")
+elif pendentes['full']:
+    st.sidebar.info("Sincronização completa pendente: execute o provisionamento completo")
+elif pendentes['sales'] or pendentes['purchases']:
+    rotulo = (f"⚡ Reprovisionar Alterações ({len(pendentes['sales'])} vendas, "
+              f"{len(pendentes['purchases'])} compras)")
+    if st.sidebar.button(rotulo, key="prov_inc_btn", disabled=em_execucao):
+        executar_provisioning_incremental(estrategia)
+        st.sidebar.success("Provisionamento incremental iniciado!")
+
 # Status do provisionamento
-prov_status = provisioning_min_distance.status
 if prov_status == "Executando":
     st.sidebar.markdown(f'<p class="status-running">Status: {prov_status}</p>', unsafe_allow_html=True)
-    st.sidebar.progress(provisioning_min_distance.progress / 100)
+    st.sidebar.progress(prov_snap['progress'] / 100)
 elif prov_status == "Erro":
     st.sidebar.markdown(f'<p class="status-error">Status: {prov_status}</p>', unsafe_allow_html=True)
 elif prov_status == "Concluído":
@@ -195,7 +350,7 @@ with tab1:
     st.header("📊 Dashboard Geral")
     
     # Carregar dados para métricas
-    df_prov = carregar_dados_provisionamento()
+    df_prov = carregar_dados_provisionamento(tabela_cenario)
     
     if not df_prov.empty:
         # Métricas principais
@@ -267,32 +422,32 @@ with tab2:
     st.header("🔄 Sincronização de Combinações")
     
     # Métricas da sincronização
-    if sync_combinations.stats:
+    if sync_snap['stats']:
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Operações", sync_combinations.stats.get('total_operations', 0))
+            st.metric("Operações", sync_snap['stats'].get('total_operations', 0))
         
         with col2:
-            st.metric("Vendas", sync_combinations.stats.get('total_sales', 0))
+            st.metric("Vendas", sync_snap['stats'].get('total_sales', 0))
         
         with col3:
-            st.metric("Compras", sync_combinations.stats.get('total_purchases', 0))
+            st.metric("Compras", sync_snap['stats'].get('total_purchases', 0))
         
         with col4:
-            st.metric("Combinações", sync_combinations.stats.get('total_combinations', 0))
+            st.metric("Combinações", sync_snap['stats'].get('total_combinations', 0))
         
         # Distâncias por comprador
-        if sync_combinations.stats.get('buyer_distances'):
+        if sync_snap['stats'].get('buyer_distances'):
             st.subheader("📏 Distância Média por Comprador")
             buyer_data = []
-            for buyer, distances in sync_combinations.stats['buyer_distances'].items():
-                if distances:
-                    avg_dist = sum(distances) / len(distances)
+            for buyer, entry in sync_snap['stats']['buyer_distances'].items():
+                if entry['routes']:
+                    avg_dist = entry['total_km'] / entry['routes']
                     buyer_data.append({
                         'Comprador': buyer,
                         'Distância Média (km)': avg_dist,
-                        'Número de Rotas': len(distances)
+                        'Número de Rotas': entry['routes']
                     })
             
             if buyer_data:
@@ -313,8 +468,8 @@ with tab2:
     
     # Logs da sincronização
     st.subheader("📝 Logs da Sincronização")
-    if sync_combinations.logs:
-        logs_text = "\n".join(sync_combinations.logs[-20:])  # Últimos 20 logs
+    if sync_snap['logs']:
+        logs_text = "\n".join(sync_snap['logs'][-20:])  # Últimos 20 logs
         st.markdown(f'<div class="log-container">{logs_text}</div>', unsafe_allow_html=True)
     else:
         st.info("Nenhum log disponível. Execute a sincronização para ver os logs.")
@@ -323,41 +478,41 @@ with tab3:
     st.header("📦 Provisionamento por Distância Mínima")
     
     # Métricas do provisionamento
-    if provisioning_min_distance.stats:
+    if prov_snap['stats']:
         col1, col2, col3 = st.columns(3)
         
         with col1:
             st.metric("Combinações Processadas", 
-                     f"{provisioning_min_distance.stats.get('processed_combinations', 0)}/{provisioning_min_distance.stats.get('total_combinations', 0)}")
+                     f"{prov_snap['stats'].get('processed_combinations', 0)}/{prov_snap['stats'].get('total_combinations', 0)}")
         
         with col2:
-            total_allocated = provisioning_min_distance.stats.get('total_allocated', 0)
+            total_allocated = prov_snap['stats'].get('total_allocated', 0)
             st.metric("Sacas Alocadas", f"{total_allocated:,.0f}")
         
         with col3:
-            avg_distance = provisioning_min_distance.stats.get('average_distance', 0)
+            avg_distance = prov_snap['stats'].get('average_distance', 0)
             st.metric("Distância Média", f"{avg_distance:.1f} km")
         
         # Métricas financeiras
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            total_revenue = provisioning_min_distance.stats.get('total_revenue', 0)
+            total_revenue = prov_snap['stats'].get('total_revenue', 0)
             st.metric("Receita Total", f"R$ {total_revenue:,.2f}")
         
         with col2:
-            total_cost = provisioning_min_distance.stats.get('total_cost', 0)
+            total_cost = prov_snap['stats'].get('total_cost', 0)
             st.metric("Custo Total", f"R$ {total_cost:,.2f}")
         
         with col3:
-            total_profit = provisioning_min_distance.stats.get('total_profit', 0)
+            total_profit = prov_snap['stats'].get('total_profit', 0)
             st.metric("Lucro Total", f"R$ {total_profit:,.2f}")
         
         # Totais por grão
-        if provisioning_min_distance.stats.get('grain_totals'):
+        if prov_snap['stats'].get('grain_totals'):
             st.subheader("🌾 Distribuição por Grão")
             grain_data = []
-            for grain, qty in provisioning_min_distance.stats['grain_totals'].items():
+            for grain, qty in prov_snap['stats']['grain_totals'].items():
                 grain_data.append({'Grão': grain, 'Quantidade': qty})
             
             df_grains = pd.DataFrame(grain_data)
@@ -370,10 +525,43 @@ with tab3:
             )
             st.plotly_chart(fig_grains, use_container_width=True)
     
+    # Histórico de cenários
+    st.subheader("🕓 Histórico de Cenários")
+    df_cenarios = listar_cenarios(tabela_cenario)
+    if not df_cenarios.empty:
+        st.dataframe(df_cenarios, use_container_width=True)
+        ids_cenarios = df_cenarios['scenario_id'].tolist()
+        
+        with st.expander("Ver linhas de um cenário"):
+            cenario_id = st.selectbox("Cenário", ids_cenarios, key="cenario_detalhe")
+            st.dataframe(carregar_cenario(cenario_id), use_container_width=True)
+        
+        if len(ids_cenarios) >= 2:
+            col1, col2 = st.columns(2)
+            with col1:
+                base_id = st.selectbox("Cenário base", ids_cenarios, index=1, key="cenario_base")
+            with col2:
+                novo_id = st.selectbox("Cenário comparado", ids_cenarios, index=0, key="cenario_novo")
+            
+            df_diff = comparar_cenarios(base_id, novo_id)
+            if df_diff.empty:
+                st.info("Os cenários têm as mesmas alocações.")
+            else:
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Rotas Alteradas", len(df_diff))
+                with col2:
+                    st.metric("Diferença de Sacas", f"{float(df_diff['diferenca_sacas'].sum()):,.0f}")
+                with col3:
+                    st.metric("Diferença de Lucro", f"R$ {float(df_diff['diferenca_lucro'].sum()):,.2f}")
+                st.dataframe(df_diff, use_container_width=True)
+    else:
+        st.info("Nenhum cenário no histórico.")
+    
     # Logs do provisionamento
     st.subheader("📝 Logs do Provisionamento")
-    if provisioning_min_distance.logs:
-        logs_text = "\n".join(provisioning_min_distance.logs[-20:])  # Últimos 20 logs
+    if prov_snap['logs']:
+        logs_text = "\n".join(prov_snap['logs'][-20:])  # Últimos 20 logs
         st.markdown(f'<div class="log-container">{logs_text}</div>', unsafe_allow_html=True)
     else:
         st.info("Nenhum log disponível. Execute o provisionamento para ver os logs.")
@@ -381,7 +569,7 @@ with tab3:
 with tab4:
     st.header("🗺️ Mapa de Rotas Otimizadas")
     
-    df_prov = carregar_dados_provisionamento()
+    df_prov = carregar_dados_provisionamento(tabela_cenario)
     
     if not df_prov.empty:
         # Filtros para o mapa
@@ -506,16 +694,16 @@ with tab5:
     
     # Logs da sincronização
     st.subheader("🔄 Logs da Sincronização")
-    if sync_combinations.logs:
-        logs_sync = "\n".join(sync_combinations.logs)
+    if sync_snap['logs']:
+        logs_sync = "\n".join(sync_snap['logs'])
         st.text_area("Logs Sincronização", logs_sync, height=300, key="logs_sync")
     else:
         st.info("Nenhum log de sincronização disponível.")
     
     # Logs do provisionamento
     st.subheader("📦 Logs do Provisionamento")
-    if provisioning_min_distance.logs:
-        logs_prov = "\n".join(provisioning_min_distance.logs)
+    if prov_snap['logs']:
+        logs_prov = "\n".join(prov_snap['logs'])
         st.text_area("Logs Provisionamento", logs_prov, height=300, key="logs_prov")
     else:
         st.info("Nenhum log de provisionamento disponível.")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estratégias de ordenação das combinações para o provisionamento guloso
+"""
+
+# Distância mínima considerada no lucro por km, evitando divisão por zero
+MIN_DISTANCE_KM = 1.0
+
+
+class AllocationStrategy:
+    """Critério de prioridade das combinações: a alocação percorre os pares do melhor para o pior"""
+
+    name = None
+    label = None
+    table_name = None
+    sort = None           # ordenação no MongoDB
+    index = None          # índice que atende a ordenação, quando ela usa só campos gravados
+    fields = None         # campos calculados antes da ordenação
+    uses_profit = False   # pair_key precisa do lucro por saca
+
+    def pipeline(self, projection, match=None):
+        """Estágios de agregação que entregam as combinações projetadas na ordem da estratégia"""
+        stages = [{'$match': match}] if match else []
+        if not self.fields:
+            # $sort logo no início usa o índice
+            return stages + [{'$sort': self.sort}, {'$project': projection}]
+        return stages + [{'$project': projection}, {'$addFields': self.fields}, {'$sort': self.sort}]
+
+    def pair_key(self, distance, profit):
+        """Chave de prioridade do par (menor primeiro), consistente com a ordenação do MongoDB"""
+        raise NotImplementedError
+
+
+class MinDistanceStrategy(AllocationStrategy):
+    name = 'min_distance'
+    label = 'distância mínima'
+    table_name = 'provisioningsv2_best_scenario_distance'
+    sort = {'distance': 1}
+    index = [('distance', 1)]
+
+    def pair_key(self, distance, profit):
+        return distance
+
+
+class MaxProfitStrategy(AllocationStrategy):
+    name = 'max_profit'
+    label = 'lucro máximo'
+    table_name = 'provisioningsv2_best_scenario_profit'
+    sort = {'profit': -1}
+    index = [('profit', -1)]
+    uses_profit = True
+
+    def pair_key(self, distance, profit):
+        return -profit
+
+
+class MaxProfitPerKmStrategy(AllocationStrategy):
+    name = 'max_profit_per_km'
+    label = 'lucro máximo por km'
+    table_name = 'provisioningsv2_best_scenario_profit_per_km'
+    sort = {'profitPerKm': -1}
+    fields = {'profitPerKm': {'$divide': ['$profit', {'$max': ['$distance', MIN_DISTANCE_KM]}]}}
+    uses_profit = True
+
+    def pair_key(self, distance, profit):
+        return -profit / max(distance, MIN_DISTANCE_KM)
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (MinDistanceStrategy(), MaxProfitStrategy(), MaxProfitPerKmStrategy())
+}
+
+
+def get_strategy(name):
+    """Retorna a estratégia pelo nome"""
+    if name not in STRATEGIES:
+        raise ValueError(f"Estratégia inválida: {name} (opções: {', '.join(STRATEGIES)})")
+    return STRATEGIES[name]
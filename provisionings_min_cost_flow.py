@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Módulo de provisionamento ótimo por fluxo de custo mínimo (problema de transporte)
+"""
+
+import threading
+
+import numpy as np
+
+from provisionings_min_distance import ProvisioningMinDistance, GRAIN_NAMES, prepare
+
+# Custo unitário (por saca) minimizado em cada modo
+FLOW_OBJECTIVES = ('distance', 'freight', 'profit')
+
+# Configurações do fluxo de custo mínimo
+MIN_COST_FLOW_CONFIG = {
+    'objective': 'distance'    # 'distance', 'freight' ou 'profit' (custo = -lucro)
+}
+
+
+class GrainNetwork:
+    """Rede de transporte de um grão: origens (oferta) × destinos (demanda) em matrizes densas"""
+
+    def __init__(self, grain):
+        self.grain = grain
+        self.dest_index = {}
+        self.orig_index = {}
+        self.dests = []
+        self.origs = []
+        self.pairs = []
+
+    def add(self, comb):
+        """Registra uma combinação, internando destino e origem na primeira ocorrência"""
+        i = self.dest_index.get(comb['destinationOrder'])
+        if i is None:
+            i = self.dest_index[comb['destinationOrder']] = len(self.dests)
+            self.dests.append(comb)
+        j = self.orig_index.get(comb['originOrder'])
+        if j is None:
+            j = self.orig_index[comb['originOrder']] = len(self.origs)
+            self.origs.append(comb)
+        self.pairs.append((i, j, comb['distance'], comb['freightCost'], comb['profit']))
+
+    def matrices(self):
+        """Retorna matrizes destinos × origens de distância, frete e lucro (NaN fora das combinações)"""
+        shape = (len(self.dests), len(self.origs))
+        dist, freight, profit = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+        if self.pairs:
+            i, j, d, f, p = (np.array(col) for col in zip(*self.pairs))
+            i, j = i.astype(int), j.astype(int)
+            dist[i, j], freight[i, j], profit[i, j] = d, f, p
+        return dist, freight, profit
+
+
+def min_cost_flow(cost, supply, demand):
+    """
+    Fluxo máximo de custo mínimo por caminhos mínimos sucessivos (Dijkstra denso com potenciais).
+
+    cost é a matriz destinos × origens do custo unitário (inf onde não há rota);
+    supply e demand são as capacidades das origens e dos destinos.
+    Retorna a matriz de fluxo destinos × origens.
+    """
+    n_dest, n_orig = cost.shape
+    flow = np.zeros(cost.shape, dtype=np.result_type(supply, demand))
+    supply = supply.copy()
+    demand = demand.copy()
+    if not n_dest or not n_orig:
+        return flow
+
+    # Custos não negativos; somar uma constante a todas as rotas não muda o fluxo ótimo,
+    # pois todo caminho aumentante atravessa exatamente uma rota a mais no sentido direto
+    finite = np.isfinite(cost)
+    if finite.any():
+        cost = np.where(finite, cost - cost[finite].min(), np.inf)
+    cost_t = np.ascontiguousarray(cost.T)
+    pot_dest = np.zeros(n_dest)
+    pot_orig = np.zeros(n_orig)
+
+    while True:
+        # Dijkstra a partir de todas as origens com oferta restante
+        dist_orig = np.where(supply > 0, 0.0, np.inf)
+        dist_dest = np.full(n_dest, np.inf)
+        done_orig = np.zeros(n_orig, dtype=bool)
+        done_dest = np.zeros(n_dest, dtype=bool)
+        prev_dest = np.full(n_dest, -1)
+        prev_orig = np.full(n_orig, -1)
+        target = -1
+
+        while True:
+            key_orig = np.where(done_orig, np.inf, dist_orig)
+            key_dest = np.where(done_dest, np.inf, dist_dest)
+            j = int(key_orig.argmin())
+            i = int(key_dest.argmin())
+            if key_orig[j] == np.inf and key_dest[i] == np.inf:
+                break
+            if key_orig[j] <= key_dest[i]:
+                done_orig[j] = True
+                # Rotas diretas origem → destino com custo reduzido
+                cand = dist_orig[j] + cost_t[j] + pot_orig[j] - pot_dest
+                better = ~done_dest & (cand < dist_dest)
+                dist_dest[better] = cand[better]
+                prev_dest[better] = j
+            else:
+                done_dest[i] = True
+                if demand[i] > 0:
+                    target = i
+                    break
+                # Arestas reversas destino → origem sobre o fluxo já alocado
+                cand = dist_dest[i] - (cost[i] + pot_orig - pot_dest[i])
+                better = (flow[i] > 0) & ~done_orig & (cand < dist_orig)
+                dist_orig[better] = cand[better]
+                prev_orig[better] = i
+
+        if target < 0:
+            return flow
+
+        # Caminho: alterna rotas diretas (aumentam o fluxo) e reversas (diminuem)
+        path = []
+        i = target
+        while True:
+            j = prev_dest[i]
+            path.append((i, j))
+            if prev_orig[j] < 0:
+                break
+            i = prev_orig[j]
+        delta = min(demand[target], supply[path[-1][1]])
+        for k in range(1, len(path)):
+            delta = min(delta, flow[path[k][0], path[k - 1][1]])
+
+        for k, (i, j) in enumerate(path):
+            flow[i, j] += delta
+            if k:
+                flow[i, path[k - 1][1]] -= delta
+        demand[target] -= delta
+        supply[path[-1][1]] -= delta
+
+        # Potenciais mantêm os custos reduzidos não negativos
+        limit = dist_dest[target]
+        pot_orig += np.minimum(dist_orig, limit)
+        pot_dest += np.minimum(dist_dest, limit)
+
+
+class ProvisioningMinCostFlow(ProvisioningMinDistance):
+    """Provisionamento ótimo: maior volume alocado com o menor custo total no objetivo escolhido"""
+
+    table_name = 'provisioningsv2_best_scenario_min_cost_flow'
+    label = 'fluxo de custo mínimo'
+
+    def __init__(self, **config):
+        super().__init__(**{**MIN_COST_FLOW_CONFIG, **config})
+        if self.config['objective'] not in FLOW_OBJECTIVES:
+            raise ValueError(f"Objetivo inválido: {self.config['objective']}")
+
+    @property
+    def strategy_name(self):
+        return f"min_cost_flow_{self.config['objective']}"
+
+    def load_networks(self, combinations):
+        """Agrupa as combinações do cursor em uma rede de transporte por grão"""
+        networks = {}
+        for comb in combinations:
+            grain = comb.get('grain')
+            network = networks.get(grain)
+            if network is None:
+                network = networks[grain] = GrainNetwork(grain)
+            network.add(comb)
+        return list(networks.values())
+
+    def solve_network(self, network):
+        """Resolve o transporte ótimo de um grão e retorna as linhas alocadas"""
+        dist, freight, profit = network.matrices()
+        unit_cost = {'distance': dist, 'freight': freight, 'profit': -profit}[self.config['objective']]
+        cost = np.where(np.isnan(unit_cost), np.inf, unit_cost)
+
+        supply = np.array([o['amountOrigin'] for o in network.origs])
+        demand = np.array([
+            d.get('amountProvisionedOriginal', d['amountDestination']) for d in network.dests
+        ])
+        flow = min_cost_flow(cost, np.maximum(supply, 0), np.maximum(demand, 0))
+
+        grao_name = GRAIN_NAMES.get(network.grain) or prepare(network.grain)
+        rows = []
+        for i, j in zip(*np.nonzero(flow > 0)):
+            dest, orig = network.dests[i], network.origs[j]
+            qty = flow[i, j].item()
+            rows.append((
+                prepare(dest['destinationOrder']),
+                prepare(orig['originOrder']),
+                dest.get('buyer'),
+                orig.get('seller'),
+                grao_name,
+                qty,
+                dest['destinationPrice'] * qty,
+                orig['originPrice'] * qty,
+                freight[i, j].item() * qty,
+                (orig['originCredit'] - dest['destinationTax']) * qty,
+                profit[i, j].item() * qty,
+                dist[i, j].item(),
+                orig.get('from_coords', [None, None]),
+                dest.get('to_coords', [None, None])
+            ))
+        return rows
+
+    def allocate_component(self, match):
+        """Fluxo ótimo restrito ao componente: componentes disjuntos não trocam oferta nem demanda"""
+        return self.allocate(match)
+
+    def allocate(self, match=None):
+        """Carrega as combinações e resolve o fluxo de custo mínimo de cada grão"""
+        try:
+            combinations = self.load_combinations(match)
+            if combinations is None or not self.stats['total_combinations']:
+                return []
+
+            networks = self.load_networks(combinations)
+            self.log(f"=== Iniciando fluxo de custo mínimo ({self.config['objective']}) "
+                     f"em {len(networks)} grãos ===")
+
+            rows = []
+            for n, network in enumerate(networks, start=1):
+                grain_rows = self.solve_network(network)
+                self.log(f"Grão {GRAIN_NAMES.get(network.grain) or prepare(network.grain)}: "
+                         f"{len(network.dests)} destinos × {len(network.origs)} origens, "
+                         f"{len(grain_rows)} alocações")
+                rows.extend(grain_rows)
+                self.progress = (n / len(networks)) * 80 + 10  # 10-90%
+
+            self.stats['processed_combinations'] = self.stats['total_combinations']
+            self.summarize_rows(rows)
+            return rows
+        except Exception as e:
+            self.log(f"Erro no fluxo de custo mínimo: {str(e)}", "ERROR")
+            return []
+
+# Instância global, criada no primeiro uso: importar o módulo não instancia o provisionador
+_provisioning_min_cost_flow = None
+_instance_lock = threading.Lock()
+
+
+def get_provisioning_min_cost_flow():
+    """Retorna a instância global do fluxo de custo mínimo, criando-a na primeira chamada"""
+    global _provisioning_min_cost_flow
+    with _instance_lock:
+        if _provisioning_min_cost_flow is None:
+            _provisioning_min_cost_flow = ProvisioningMinCostFlow()
+        return _provisioning_min_cost_flow
@@ -1,23 +1,216 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Módulo de provisionamento baseado em distância mínima
+Módulo de provisionamento guloso (distância mínima por padrão, ou outra estratégia de ordenação)
 """
 
 from pymongo import MongoClient
 from bson import ObjectId
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.extras import execute_values, Json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import heapq
 from datetime import datetime
+import io
+import math
+import multiprocessing
 import streamlit as st
+import threading
 import traceback
 
+from sync_combinations import (SyncCombinations, pair_metrics, load_pending_changes,
+                               resolve_pending_changes, register_scenario_table)
+from provisioning_strategies import get_strategy
+from combination_columns import CombinationColumns
+from job_telemetry import JobTelemetry, TELEMETRY_CONFIG
+
 # Mapeia IDs de grão para nomes legíveis
 GRAIN_NAMES = {
     ObjectId('5e349bed3b0fd74ea91f1488'): 'milho',
     ObjectId('5e349c053b0fd74ea91f148a'): 'sorgo'
 }
 
+# Configurações do provisionamento
+PROVISIONING_CONFIG = {
+    'strategy': 'min_distance',   # ordenação das combinações (ver provisioning_strategies.STRATEGIES)
+    'source': 'combinations',     # 'combinations' (cursor ordenado), 'columns' (cursor em arrays) ou 'orders' (heaps)
+    'cursor_batch_size': 2000,    # combinações por lote do cursor ordenado
+    'pg_write_method': 'copy',    # 'copy' (COPY FROM STDIN) ou 'values' (INSERT com execute_values)
+    'copy_chunk_rows': 50000,     # linhas por buffer do COPY
+    'keep_history': True,         # guarda cada execução em provisioningsv2_scenario_rows
+    'scenario_retention': 10,     # cenários mantidos por tabela (None = todos)
+    'sync_config': {},            # configuração do carregamento de ordens quando source='orders'
+    'parallel_workers': None      # None ou 1 = serial; >1 aloca cada grão em um processo (source='combinations')
+}
+
+# Contadores de leitura somados entre as partições da alocação paralela
+PARTITION_COUNTERS = (
+    'total_combinations',
+    'total_destinations',
+    'total_origins',
+    'processed_combinations',
+    'skipped_combinations',
+    'unread_combinations'
+)
+
+# Campos das combinações lidos pela alocação
+COMBINATION_PROJECTION = {
+    '_id': 0,
+    'destinationOrder': 1,
+    'originOrder': 1,
+    'buyer': 1,
+    'seller': 1,
+    'grain': 1,
+    'distance': 1,
+    'amountProvisionedOriginal': 1,
+    'amountDestination': 1,
+    'amountOrigin': 1,
+    'destinationPrice': 1,
+    'originPrice': 1,
+    'freightCost': 1,
+    'originCredit': 1,
+    'destinationTax': 1,
+    'profit': 1,
+    'from_coords': 1,
+    'to_coords': 1
+}
+
+# Colunas gravadas na tabela do cenário, na ordem das linhas alocadas
+SCENARIO_COLUMNS = (
+    'destination_order',
+    'origin_order',
+    'buyer',
+    'seller',
+    'grain',
+    'amount_allocated',
+    'revenue',
+    'cost',
+    'freight',
+    'tax_balance',
+    'profit_total',
+    'distance',
+    'from_coords',
+    'to_coords'
+)
+
+# Esquema da tabela de cenário
+SCENARIO_TABLE_DDL = '''
+CREATE TABLE IF NOT EXISTS {table} (
+  id SERIAL PRIMARY KEY,
+  destination_order TEXT,
+  origin_order TEXT,
+  buyer TEXT,
+  seller TEXT,
+  grain TEXT,
+  amount_allocated NUMERIC,
+  revenue NUMERIC,
+  cost NUMERIC,
+  freight NUMERIC,
+  tax_balance NUMERIC,
+  profit_total NUMERIC,
+  distance NUMERIC,
+  from_coords FLOAT[],
+  to_coords FLOAT[]
+);
+'''
+
+# Uma linha por par destino/origem: chave das atualizações incrementais
+SCENARIO_PAIR_INDEX_DDL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS {table}_pair_key ON {table} (destination_order, origin_order);"
+)
+
+# Migrações das tabelas de cenário, aplicadas uma única vez por tabela
+MIGRATIONS_TABLE_DDL = '''
+CREATE TABLE IF NOT EXISTS provisioningsv2_schema_migrations (
+  table_name TEXT,
+  version INTEGER,
+  applied_at TIMESTAMP DEFAULT now(),
+  PRIMARY KEY (table_name, version)
+);
+'''
+
+SCENARIO_MIGRATIONS = [
+    (1, [SCENARIO_TABLE_DDL]),
+    # Tabelas criadas antes das colunas de comprador, vendedor e coordenadas
+    (2, [
+        "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS buyer TEXT;",
+        "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS seller TEXT;",
+        "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS from_coords FLOAT[];",
+        "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS to_coords FLOAT[];"
+    ]),
+    (3, [SCENARIO_PAIR_INDEX_DDL])
+]
+
+# Histórico de cenários: metadados de cada execução e linhas particionadas por scenario_id
+HISTORY_TABLE = 'provisioningsv2_scenario_rows'
+
+HISTORY_MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS provisioningsv2_scenarios (
+          scenario_id SERIAL PRIMARY KEY,
+          strategy TEXT,
+          table_name TEXT,
+          created_at TIMESTAMP DEFAULT now(),
+          row_count INTEGER,
+          total_allocated NUMERIC,
+          total_revenue NUMERIC,
+          total_cost NUMERIC,
+          total_profit NUMERIC,
+          total_freight NUMERIC,
+          total_tax_balance NUMERIC,
+          average_distance NUMERIC,
+          grain_totals JSONB
+        );
+        ''',
+        "CREATE INDEX IF NOT EXISTS provisioningsv2_scenarios_table_idx "
+        "ON provisioningsv2_scenarios (table_name, scenario_id);",
+        '''
+        CREATE TABLE IF NOT EXISTS {table} (
+          scenario_id INTEGER NOT NULL,
+          id INTEGER,
+          destination_order TEXT,
+          origin_order TEXT,
+          buyer TEXT,
+          seller TEXT,
+          grain TEXT,
+          amount_allocated NUMERIC,
+          revenue NUMERIC,
+          cost NUMERIC,
+          freight NUMERIC,
+          tax_balance NUMERIC,
+          profit_total NUMERIC,
+          distance NUMERIC,
+          from_coords FLOAT[],
+          to_coords FLOAT[]
+        ) PARTITION BY LIST (scenario_id);
+        '''
+    ]),
+    # Cenários incrementais guardam só as linhas dos destinos do componente sobre o cenário base
+    (2, [
+        "ALTER TABLE provisioningsv2_scenarios ADD COLUMN IF NOT EXISTS base_scenario_id INTEGER;",
+        "ALTER TABLE provisioningsv2_scenarios ADD COLUMN IF NOT EXISTS component_destinations TEXT[];"
+    ])
+]
+
+# Linhas completas de um cenário do histórico: percorre a cadeia de cenários base e, de
+# cada um, só mantém os destinos que nenhum cenário mais novo da cadeia regravou
+SCENARIO_ROWS_QUERY = '''
+WITH RECURSIVE chain AS (
+  SELECT scenario_id, base_scenario_id, component_destinations, 0 AS depth
+  FROM provisioningsv2_scenarios WHERE scenario_id = %({param})s
+  UNION ALL
+  SELECT s.scenario_id, s.base_scenario_id, s.component_destinations, c.depth + 1
+  FROM provisioningsv2_scenarios s JOIN chain c ON s.scenario_id = c.base_scenario_id
+)
+SELECT r.* FROM chain c
+JOIN provisioningsv2_scenario_rows r ON r.scenario_id = c.scenario_id
+WHERE NOT EXISTS (
+  SELECT 1 FROM chain n
+  WHERE n.depth < c.depth AND r.destination_order = ANY(n.component_destinations)
+)
+'''
+
 # Configurações do banco de dados
 DB_CONFIG = {
     'host': '24.199.75.66',
@@ -33,16 +226,58 @@ def prepare(val):
         return str(val)
     return val
 
+def csv_field(val):
+    """Codifica um valor no formato CSV do COPY (vazio sem aspas = NULL)"""
+    if val is None:
+        return ''
+    if isinstance(val, str):
+        return '"' + val.replace('"', '""') + '"'
+    if isinstance(val, (list, tuple)):
+        return '"{' + ','.join('NULL' if v is None else str(v) for v in val) + '}"'
+    return str(val)
+
+def allocate_partition(config, grain):
+    """Aloca as combinações de um grão dentro de um processo do pool"""
+    worker = ProvisioningMinDistance(**config)
+    if not worker.connect_mongodb():
+        raise RuntimeError("Falha ao conectar ao MongoDB no processo de alocação")
+    
+    try:
+        combinations = worker.load_combinations({'grain': grain})
+        if combinations is None:
+            raise RuntimeError(f"Falha ao carregar as combinações do grão {prepare(grain)}")
+        keys = []
+        rows = worker.process_allocations(combinations, keys) if worker.stats['total_combinations'] else []
+        
+        return {
+            'rows': rows,
+            'keys': keys,
+            'stats': {key: worker.stats[key] for key in PARTITION_COUNTERS}
+        }
+    finally:
+        if worker.mongo_client:
+            worker.mongo_client.close()
+
 class ProvisioningMinDistance:
-    def __init__(self):
+    def __init__(self, **config):
+        self.config = {**PROVISIONING_CONFIG, **config}
+        self.strategy = get_strategy(self.config['strategy'])
         self.mongo_client = None
         self.db = None
         self.pg_conn = None
+        self.scenario_id = None
+        self.telemetry = JobTelemetry()
+        self.open_destinations = {}
+        self.open_origins = {}
+        self.stats = self.new_stats()
         self.status = "Não iniciado"
-        self.progress = 0
-        self.logs = []
-        self.stats = {
+    
+    def new_stats(self):
+        """Estatísticas zeradas de uma execução"""
+        return {
             'total_combinations': 0,
+            'total_destinations': 0,
+            'total_origins': 0,
             'total_allocated': 0,
             'total_revenue': 0,
             'total_cost': 0,
@@ -51,15 +286,62 @@ class ProvisioningMinDistance:
             'total_tax_balance': 0,
             'average_distance': 0,
             'grain_totals': {},
-            'processed_combinations': 0
+            'processed_combinations': 0,
+            'skipped_combinations': 0,
+            'unread_combinations': 0,
+            'rows_upserted': 0,
+            'rows_deleted': 0
         }
     
+    @property
+    def table_name(self):
+        """Tabela do cenário gerado pela estratégia"""
+        return self.strategy.table_name
+    
+    @property
+    def strategy_name(self):
+        """Identificador da estratégia gravado no histórico de cenários"""
+        return self.strategy.name
+    
+    @property
+    def label(self):
+        """Descrição do critério de alocação nos logs"""
+        return self.strategy.label
+    
+    def use_strategy(self, name):
+        """Troca a estratégia das próximas execuções; recusada durante uma execução desta instância"""
+        if self.status == "Executando":
+            raise RuntimeError(f"Provisionamento por {self.label} em execução: estratégia não pode ser trocada")
+        self.strategy = get_strategy(name)
+        self.config['strategy'] = name
+    
+    @property
+    def status(self):
+        return self.telemetry.status
+    
+    @status.setter
+    def status(self, value):
+        self.telemetry.set_status(value, self.stats)
+    
+    @property
+    def progress(self):
+        return self.telemetry.progress
+    
+    @progress.setter
+    def progress(self, value):
+        self.telemetry.set_progress(value, self.stats)
+    
+    @property
+    def logs(self):
+        return self.telemetry.logs()
+    
+    def report_progress(self, value):
+        """Progresso de um laço, publicado no máximo a cada intervalo mínimo da telemetria"""
+        return self.telemetry.report_progress(value, self.stats)
+    
     def log(self, message, level="INFO"):
         """Adiciona log com timestamp"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] [{level}] {message}"
-        self.logs.append(log_entry)
-        print(log_entry)
+        self.telemetry.log(message, level)
     
     def connect_mongodb(self):
         """Conecta ao MongoDB"""
@@ -86,79 +368,162 @@ class ProvisioningMinDistance:
             self.log(f"Erro ao conectar PostgreSQL: {str(e)}", "ERROR")
             return False
     
-    def load_combinations(self):
-        """Carrega combinações ordenadas por distância"""
+    def load_combinations(self, match=None):
+        """Abre um cursor de combinações na ordem da estratégia, sem carregá-las na memória"""
         try:
             comb_col = self.db['provisioningsv2Combinations']
-            comb_list = list(comb_col.find({}).sort('distance', 1))
-            self.stats['total_combinations'] = len(comb_list)
-            self.log(f"{len(comb_list)} combinações carregadas e ordenadas por distância")
-            return comb_list
+            
+            # Índice evita o sort em memória do MongoDB (limitado) e permite ler em lotes
+            if self.strategy.index:
+                comb_col.create_index(self.strategy.index)
+            
+            self.stats['total_combinations'] = comb_col.count_documents(match or {})
+            self.open_destinations = self.count_orders_by_grain(comb_col, 'destinationOrder', match)
+            self.open_origins = self.count_orders_by_grain(comb_col, 'originOrder', match)
+            self.stats['total_destinations'] = sum(self.open_destinations.values())
+            self.stats['total_origins'] = sum(self.open_origins.values())
+            
+            cursor = comb_col.aggregate(
+                self.strategy.pipeline(COMBINATION_PROJECTION, match),
+                allowDiskUse=True,
+                batchSize=self.config['cursor_batch_size']
+            )
+            self.log(f"{self.stats['total_combinations']} combinações a processar por {self.strategy.label} "
+                     f"({self.stats['total_destinations']} destinos, {self.stats['total_origins']} origens)")
+            return cursor
         except Exception as e:
             self.log(f"Erro ao carregar combinações: {str(e)}", "ERROR")
-            return []
+            return None
+    
+    def count_orders_by_grain(self, comb_col, field, match=None):
+        """Conta os pedidos distintos de cada grão no campo informado"""
+        pipeline = [
+            {'$group': {'_id': {'grain': '$grain', 'order': f'${field}'}}},
+            {'$group': {'_id': '$_id.grain', 'count': {'$sum': 1}}}
+        ]
+        if match:
+            pipeline.insert(0, {'$match': match})
+        return {d['_id']: d['count'] for d in comb_col.aggregate(pipeline, allowDiskUse=True)}
+    
+    def apply_migrations(self, cursor, table, migrations):
+        """Aplica uma única vez, por tabela, as migrações de esquema pendentes"""
+        cursor.execute(MIGRATIONS_TABLE_DDL)
+        # Serializa execuções concorrentes da mesma migração
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table,))
+        cursor.execute(
+            "SELECT version FROM provisioningsv2_schema_migrations WHERE table_name = %s",
+            (table,)
+        )
+        applied = {version for version, in cursor.fetchall()}
+        
+        for version, statements in migrations:
+            if version in applied:
+                continue
+            for statement in statements:
+                cursor.execute(statement.format(table=table))
+            cursor.execute(
+                "INSERT INTO provisioningsv2_schema_migrations (table_name, version) VALUES (%s, %s)",
+                (table, version)
+            )
+            self.log(f"Migração {version} aplicada em {table}")
+    
+    def migrate_scenario_table(self, cursor):
+        """Migra a tabela do cenário e, se habilitado, as tabelas de histórico"""
+        self.apply_migrations(cursor, self.table_name, SCENARIO_MIGRATIONS)
+        if self.config['keep_history']:
+            self.apply_migrations(cursor, HISTORY_TABLE, HISTORY_MIGRATIONS)
     
     def prepare_postgresql_table(self):
-        """Prepara tabela no PostgreSQL"""
+        """Prepara a tabela de staging que receberá o novo cenário"""
         try:
             cursor = self.pg_conn.cursor()
             
-            # Cria tabela se não existir
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS provisioningsv2_best_scenario_distance (
-              id SERIAL PRIMARY KEY,
-              destination_order TEXT,
-              origin_order TEXT,
-              buyer TEXT,
-              seller TEXT,
-              grain TEXT,
-              amount_allocated NUMERIC,
-              revenue NUMERIC,
-              cost NUMERIC,
-              freight NUMERIC,
-              tax_balance NUMERIC,
-              profit_total NUMERIC,
-              distance NUMERIC,
-              from_coords FLOAT[],
-              to_coords FLOAT[]
-            );
-            ''')
-            
-            # Adiciona colunas se não existirem
-            cursor.execute("ALTER TABLE provisioningsv2_best_scenario_distance ADD COLUMN IF NOT EXISTS buyer TEXT;")
-            cursor.execute("ALTER TABLE provisioningsv2_best_scenario_distance ADD COLUMN IF NOT EXISTS seller TEXT;")
-            cursor.execute("ALTER TABLE provisioningsv2_best_scenario_distance ADD COLUMN IF NOT EXISTS from_coords FLOAT[];")
-            cursor.execute("ALTER TABLE provisioningsv2_best_scenario_distance ADD COLUMN IF NOT EXISTS to_coords FLOAT[];")
-            
-            # Limpa dados existentes
-            cursor.execute('TRUNCATE provisioningsv2_best_scenario_distance;')
+            self.migrate_scenario_table(cursor)
+            
+            # Staging com o esquema atual; sobras de uma execução interrompida são descartadas
+            staging = f"{self.table_name}_staging"
+            cursor.execute(f"DROP TABLE IF EXISTS {staging};")
+            cursor.execute(SCENARIO_TABLE_DDL.format(table=staging))
+            cursor.execute(SCENARIO_PAIR_INDEX_DDL.format(table=staging))
+            
+            # Os ids continuam a sequência atual, como no TRUNCATE: ajustes que referenciam
+            # linhas de cenários anteriores (carga_id) nunca apontam para linhas novas
+            cursor.execute("SELECT to_regclass(%s)", (self.table_name,))
+            if cursor.fetchone()[0] is not None:
+                cursor.execute(
+                    "SELECT pg_get_serial_sequence(%s, 'id'), pg_get_serial_sequence(%s, 'id')",
+                    (self.table_name, staging)
+                )
+                live_sequence, staging_sequence = cursor.fetchone()
+                cursor.execute(f"SELECT last_value, is_called FROM {live_sequence};")
+                last_value, is_called = cursor.fetchone()
+                cursor.execute("SELECT setval(%s, %s, %s)", (staging_sequence, last_value, is_called))
             self.pg_conn.commit()
             
-            self.log("Tabela PostgreSQL preparada e truncada")
+            self.log(f"Tabela de staging {staging} preparada")
             return True
         except Exception as e:
+            self.pg_conn.rollback()
             self.log(f"Erro ao preparar tabela PostgreSQL: {str(e)}", "ERROR")
             return False
     
-    def process_allocations(self, comb_list):
-        """Processa alocações baseadas em distância mínima"""
+    def swap_scenario_table(self, cursor):
+        """Publica o staging no lugar da tabela do cenário (dentro da transação corrente)"""
+        table = self.table_name
+        staging = f"{table}_staging"
+        
+        cursor.execute(f"DROP TABLE IF EXISTS {table};")
+        cursor.execute(f"ALTER TABLE {staging} RENAME TO {table};")
+        cursor.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {staging}_pkey TO {table}_pkey;")
+        cursor.execute(f"ALTER INDEX {staging}_pair_key RENAME TO {table}_pair_key;")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+        sequence, = cursor.fetchone()
+        cursor.execute(f"ALTER SEQUENCE {sequence} RENAME TO {table}_id_seq;")
+    
+    def _close_order(self, open_orders, grain_id):
+        """Desconta um pedido esgotado do contador de abertos do grão"""
+        if grain_id in open_orders:
+            open_orders[grain_id] -= 1
+    
+    def _grain_closed(self, open_dests, open_origs, grain_id):
+        """Um grão encerra quando não restam destinos ou origens abertos nele"""
+        return open_dests.get(grain_id, 1) <= 0 or open_origs.get(grain_id, 1) <= 0
+    
+    def process_allocations(self, combinations, keys=None):
+        """
+        Processa alocações na ordem da estratégia, consumindo as combinações sob demanda.
+        Com keys, acrescenta a chave de prioridade da combinação de cada linha alocada.
+        """
         try:
             rows = []
             destination_remaining = {}
             origin_remaining = {}
             allocated_per_dest = {}
-            result = {}
+
+            # Destinos e origens ainda abertos por grão: um grão sem destinos ou sem
+            # origens abertos está encerrado, e quando todos encerram nada mais pode ser alocado
+            open_dests = dict(self.open_destinations)
+            open_origs = dict(self.open_origins)
+            closed_grains = set()
+            skipped = 0
             
-            total_revenue = total_cost = total_profit = 0
-            total_freight = total_tax_balance = total_allocated = 0
-            total_distance_sum = 0
-            distance_count = 0
+            total = self.stats['total_combinations'] or 1
+            check_every = TELEMETRY_CONFIG['check_every']
+            idx = 0
             
-            self.log("=== Iniciando alocação por distância mínima ===")
+            self.log(f"=== Iniciando alocação por {self.strategy.label} ===")
             
-            for idx, comb in enumerate(comb_list, start=1):
-                self.progress = (idx / len(comb_list)) * 80 + 10  # 10-90%
-                self.stats['processed_combinations'] = idx
+            for idx, comb in enumerate(combinations, start=1):
+                # Progresso e log só a cada bloco de iterações e no máximo a cada intervalo da telemetria
+                if idx % check_every == 0:
+                    self.stats['processed_combinations'] = idx
+                    if self.report_progress((idx / total) * 80 + 10):  # 10-90%
+                        self.log(f"Processando {idx}/{total} - Dist={comb.get('distance', 0):.1f}km")
+                
+                grain_id = comb.get('grain')
+                if grain_id in closed_grains:
+                    skipped += 1
+                    continue
                 
                 dist = comb.get('distance', 0)
                 dest = comb['destinationOrder']
@@ -168,16 +533,23 @@ class ProvisioningMinDistance:
                 from_coords = comb.get('from_coords', [None, None])
                 to_coords = comb.get('to_coords', [None, None])
                 
-                if idx % 100 == 0:  # Log a cada 100 processados
-                    self.log(f"Processando {idx}/{len(comb_list)} - Dist={dist:.1f}km")
-                
                 # Usa amountProvisionedOriginal como base para destino
                 original_amount = comb.get('amountProvisionedOriginal', comb['amountDestination'])
-                destination_remaining.setdefault(dest, original_amount)
-                allocated_per_dest.setdefault(dest, 0)
-                origin_remaining.setdefault(orig, comb['amountOrigin'])
+                if dest not in destination_remaining:
+                    destination_remaining[dest] = original_amount
+                    allocated_per_dest[dest] = 0
+                    if original_amount <= 0:
+                        self._close_order(open_dests, grain_id)
+                if orig not in origin_remaining:
+                    origin_remaining[orig] = comb['amountOrigin']
+                    if comb['amountOrigin'] <= 0:
+                        self._close_order(open_origs, grain_id)
                 
                 if destination_remaining[dest] <= 0 or origin_remaining[orig] <= 0:
+                    if self._grain_closed(open_dests, open_origs, grain_id):
+                        closed_grains.add(grain_id)
+                        if len(closed_grains) == len(open_dests):
+                            break
                     continue
                 
                 qty = min(destination_remaining[dest], origin_remaining[orig])
@@ -198,25 +570,14 @@ class ProvisioningMinDistance:
                 destination_remaining[dest] -= qty
                 origin_remaining[orig] -= qty
                 allocated_per_dest[dest] += qty
-                total_allocated += qty
-                total_revenue += rev
-                total_cost += cost_val
-                total_profit += profit_val
-                total_freight += freight
-                total_tax_balance += tax_bal
-                
-                total_distance_sum += dist
-                distance_count += 1
+                if destination_remaining[dest] <= 0:
+                    self._close_order(open_dests, grain_id)
+                if origin_remaining[orig] <= 0:
+                    self._close_order(open_origs, grain_id)
                 
                 # Mapeia grão
-                grain_id = comb.get('grain')
                 grao_name = GRAIN_NAMES.get(grain_id) or prepare(grain_id)
                 
-                result.setdefault(dest, {'grao': grao_name, 'orders': []})['orders'].append({
-                    'originOrder': orig, 
-                    'amount': qty
-                })
-                
                 rows.append((
                     prepare(dest),
                     prepare(orig),
@@ -233,87 +594,735 @@ class ProvisioningMinDistance:
                     from_coords,
                     to_coords
                 ))
+                if keys is not None:
+                    keys.append(self.strategy.pair_key(dist, comb['profit']))
+                
+                if self._grain_closed(open_dests, open_origs, grain_id):
+                    closed_grains.add(grain_id)
+                    self.log(f"Grão {grao_name} esgotado após {idx} combinações")
+                    if len(closed_grains) == len(open_dests):
+                        break
+            
+            self.stats['processed_combinations'] = idx
+            unread = max(self.stats['total_combinations'] - idx, 0)
+            if unread:
+                self.log(f"Capacidade esgotada: {unread} combinações não lidas")
             
             # Atualiza estatísticas
-            self.stats.update({
-                'total_allocated': total_allocated,
-                'total_revenue': total_revenue,
-                'total_cost': total_cost,
-                'total_profit': total_profit,
-                'total_freight': total_freight,
-                'total_tax_balance': total_tax_balance,
-                'average_distance': total_distance_sum / distance_count if distance_count else 0
-            })
-            
-            # Calcula totais por grão
-            grain_totals = {}
-            for data in result.values():
-                grain = data['grao']
-                total = sum(o['amount'] for o in data['orders'])
-                grain_totals[grain] = grain_totals.get(grain, 0) + total
-            self.stats['grain_totals'] = grain_totals
-            
-            self.log(f"Alocação finalizada: {len(rows)} registros gerados")
-            self.log(f"Total alocado: {total_allocated} sacas")
-            self.log(f"Distância média: {self.stats['average_distance']:.2f} km")
+            self.stats['skipped_combinations'] = skipped
+            self.stats['unread_combinations'] = unread
+            self.summarize_rows(rows)
+            
+            return rows
+        except Exception as e:
+            self.log(f"Erro no processamento de alocações: {str(e)}", "ERROR")
+            return []
+    
+    def process_allocations_columnar(self, columns):
+        """Mesma alocação de process_allocations, percorrendo os arrays de CombinationColumns"""
+        try:
+            rows = []
+            destination_remaining = list(columns.dest_amount)
+            origin_remaining = list(columns.orig_amount)
+            
+            # Destinos e origens abertos por grão; esgotados desde o início já contam como fechados
+            open_dests = columns.orders_by_grain(
+                g for g, amount in zip(columns.dest_grain, destination_remaining) if amount > 0)
+            open_origs = columns.orders_by_grain(
+                g for g, amount in zip(columns.orig_grain, origin_remaining) if amount > 0)
+            grains = set(columns.dest_grain)
+            closed_grains = {g for g in grains if not open_dests.get(g) or not open_origs.get(g)}
+            
+            grain_names = [GRAIN_NAMES.get(g) or prepare(g) for g in columns.grains]
+            total = len(columns) or 1
+            check_every = TELEMETRY_CONFIG['check_every']
+            skipped = 0
+            idx = 0
+            
+            self.log(f"=== Iniciando alocação por {self.strategy.label} (arrays) ===")
+            
+            pairs = zip(columns.dest, columns.orig, columns.distance, columns.freight, columns.profit)
+            for idx, (d, o, dist, freight, profit) in enumerate(pairs, start=1):
+                if idx % check_every == 0:
+                    self.stats['processed_combinations'] = idx
+                    self.report_progress((idx / total) * 80 + 10)  # 10-90%
+                
+                grain = columns.dest_grain[d]
+                if grain in closed_grains:
+                    skipped += 1
+                    continue
+                
+                if destination_remaining[d] <= 0 or origin_remaining[o] <= 0:
+                    continue
+                
+                qty = min(destination_remaining[d], origin_remaining[o])
+                destination_remaining[d] -= qty
+                origin_remaining[o] -= qty
+                if destination_remaining[d] <= 0:
+                    open_dests[grain] -= 1
+                if origin_remaining[o] <= 0:
+                    open_origs[grain] -= 1
+                
+                qty = int(qty) if qty.is_integer() else qty
+                rows.append((
+                    prepare(columns.dest_ids[d]),
+                    prepare(columns.orig_ids[o]),
+                    columns.names[columns.dest_buyer[d]],
+                    columns.names[columns.orig_seller[o]],
+                    grain_names[grain],
+                    qty,
+                    columns.dest_price[d] * qty,
+                    columns.orig_price[o] * qty,
+                    freight * qty,
+                    (columns.orig_credit[o] - columns.dest_tax[d]) * qty,
+                    profit * qty,
+                    dist,
+                    columns.orig_coords[o],
+                    columns.dest_coords[d]
+                ))
+                
+                if open_dests[grain] <= 0 or open_origs[grain] <= 0:
+                    closed_grains.add(grain)
+                    self.log(f"Grão {grain_names[grain]} esgotado após {idx} combinações")
+                    if len(closed_grains) == len(grains):
+                        break
+            
+            self.stats['processed_combinations'] = idx
+            self.stats['skipped_combinations'] = skipped
+            self.stats['unread_combinations'] = max(len(columns) - idx, 0)
+            self.summarize_rows(rows)
             
             return rows
         except Exception as e:
             self.log(f"Erro no processamento de alocações: {str(e)}", "ERROR")
             return []
     
+    def summarize_rows(self, rows):
+        """Atualiza as estatísticas de totais a partir das linhas alocadas"""
+        # fsum é exato e não depende da ordem das linhas: serial e paralelo dão os mesmos totais
+        total_allocated = sum(row[5] for row in rows)
+        total_revenue = math.fsum(row[6] for row in rows)
+        total_cost = math.fsum(row[7] for row in rows)
+        total_freight = math.fsum(row[8] for row in rows)
+        total_tax_balance = math.fsum(row[9] for row in rows)
+        total_profit = math.fsum(row[10] for row in rows)
+        total_distance_sum = math.fsum(row[11] for row in rows)
+        grain_totals = {}
+        for row in rows:
+            grain_totals[row[4]] = grain_totals.get(row[4], 0) + row[5]
+        
+        self.stats.update({
+            'total_allocated': total_allocated,
+            'total_revenue': total_revenue,
+            'total_cost': total_cost,
+            'total_profit': total_profit,
+            'total_freight': total_freight,
+            'total_tax_balance': total_tax_balance,
+            'average_distance': total_distance_sum / len(rows) if rows else 0
+        })
+        self.stats['grain_totals'] = grain_totals
+        
+        self.log(f"Alocação finalizada: {len(rows)} registros gerados")
+        self.log(f"Total alocado: {total_allocated} sacas")
+        self.log(f"Distância média: {self.stats['average_distance']:.2f} km")
+    
+    def load_candidates(self):
+        """Monta, direto das vendas e compras, um heap de origens candidatas por destino"""
+        try:
+            loader = SyncCombinations(**self.config['sync_config'])
+            loader.db = self.db
+            loader.log = self.log
+            
+            sales, purchases = loader.load_operations()
+            if not sales or not purchases:
+                return None
+            if not loader.load_address_coords(sales, purchases):
+                return None
+            distances_map = loader.load_distances()
+            buckets = loader.group_by_grain(sales, purchases)
+            if not loader.resolve_missing_distances(buckets, distances_map):
+                return None
+            
+            # Mesmos cortes configurados para a geração de provisioningsv2Combinations
+            max_dist = loader.config['max_distance_km']
+            min_profit = loader.config['min_profit_per_bag']
+            top_k = loader.config['top_k_origins']
+            
+            destinations = []
+            for grain, grain_sales, grain_purchases in buckets:
+                dist = loader.distance_matrix(grain_sales, grain_purchases, distances_map)
+                unresolved = loader.unresolved_mask(grain_sales, grain_purchases)
+                for i, sale in enumerate(grain_sales):
+                    # Pares sem distância nem coordenadas não são candidatos
+                    kept = [
+                        (d, j) for j, d in enumerate(dist[i].tolist())
+                        if (unresolved is None or not unresolved[i, j]) and
+                        (max_dist is None or d <= max_dist) and
+                        (min_profit is None or pair_metrics(sale, grain_purchases[j], d)[4] >= min_profit)
+                    ]
+                    if top_k is not None and len(kept) > top_k:
+                        kept = heapq.nsmallest(top_k, kept)
+                    
+                    # Chave da estratégia; o índice da compra desempata, como a ordem de inserção das combinações
+                    heap = [
+                        (self.strategy.pair_key(d, pair_metrics(sale, grain_purchases[j], d)[4]
+                                                if self.strategy.uses_profit else None), j, d)
+                        for d, j in kept
+                    ]
+                    heapq.heapify(heap)
+                    destinations.append((sale, grain_purchases, heap))
+            
+            self.stats['total_combinations'] = sum(len(heap) for _, _, heap in destinations)
+            self.stats['total_destinations'] = len(destinations)
+            self.stats['total_origins'] = sum(len(p) for _, _, p in buckets)
+            self.log(f"{self.stats['total_combinations']} pares candidatos em {len(destinations)} destinos")
+            return destinations
+        except Exception as e:
+            self.log(f"Erro ao montar candidatos: {str(e)}", "ERROR")
+            return None
+    
+    def process_allocations_indexed(self, destinations):
+        """Alocação gulosa a partir dos heaps de candidatos, sem ordenar todos os pares"""
+        try:
+            rows = []
+            destination_remaining = [sale.amount_provisioned for sale, _, _ in destinations]
+            origin_remaining = {}
+            
+            def origin_left(pur):
+                return origin_remaining.get(pur.id, pur.amount)
+            
+            # Fronteira global com o melhor candidato de cada destino aberto;
+            # origens esgotadas são descartadas só quando chegam ao topo do heap do destino
+            frontier = [
+                (heap[0][0], seq, heap[0][1], heap[0][2])
+                for seq, (sale, _, heap) in enumerate(destinations)
+                if heap and destination_remaining[seq] > 0
+            ]
+            heapq.heapify(frontier)
+            
+            total = self.stats['total_combinations'] or 1
+            check_every = TELEMETRY_CONFIG['check_every']
+            processed = skipped = 0
+            
+            self.log(f"=== Iniciando alocação por {self.strategy.label} (heaps por destino) ===")
+            
+            while frontier:
+                _, seq, j, dist = heapq.heappop(frontier)
+                sale, grain_purchases, heap = destinations[seq]
+                heapq.heappop(heap)
+                pur = grain_purchases[j]
+                processed += 1
+                if processed % check_every == 0:
+                    self.stats['processed_combinations'] = processed
+                    self.report_progress((processed / total) * 80 + 10)  # 10-90%
+                
+                available = origin_left(pur)
+                if available > 0:
+                    qty = min(destination_remaining[seq], available)
+                    freight, oricredit, dentax, _, profit, _ = pair_metrics(sale, pur, dist)
+                    
+                    destination_remaining[seq] -= qty
+                    origin_remaining[pur.id] = available - qty
+                    
+                    grao_name = GRAIN_NAMES.get(sale.grain) or prepare(sale.grain)
+                    rows.append((
+                        prepare(sale.id),
+                        prepare(pur.id),
+                        sale.buyer_name,
+                        pur.seller_name,
+                        grao_name,
+                        qty,
+                        sale.bag_price * qty,
+                        pur.bag_price * qty,
+                        freight * qty,
+                        (oricredit - dentax) * qty,
+                        profit * qty,
+                        dist,
+                        pur.from_coords,
+                        sale.to_coords
+                    ))
+                
+                if destination_remaining[seq] <= 0:
+                    continue
+                
+                # Descarta origens esgotadas e promove o próximo candidato do destino
+                while heap and origin_left(grain_purchases[heap[0][1]]) <= 0:
+                    heapq.heappop(heap)
+                    skipped += 1
+                if heap:
+                    heapq.heappush(frontier, (heap[0][0], seq, heap[0][1], heap[0][2]))
+            
+            self.stats['processed_combinations'] = processed + skipped
+            self.stats['skipped_combinations'] = skipped
+            self.stats['unread_combinations'] = max(self.stats['total_combinations'] - processed - skipped, 0)
+            self.summarize_rows(rows)
+            
+            return rows
+        except Exception as e:
+            self.log(f"Erro no processamento de alocações: {str(e)}", "ERROR")
+            return []
+    
+    def allocate_parallel(self):
+        """
+        Aloca cada grão em um processo do pool. Combinações só ligam ordens do mesmo
+        grão, então as partições são independentes. Cada partição devolve as linhas
+        na ordem da estratégia com a chave de prioridade da combinação de origem, e o
+        merge por essa chave reproduz a ordem (e os ids gravados) da alocação serial;
+        só pares de grãos diferentes com a mesma chave, cuja ordem o MongoDB também
+        não define, ficam na ordem dos grãos.
+        """
+        try:
+            n_workers = self.config['parallel_workers']
+            comb_col = self.db['provisioningsv2Combinations']
+            if self.strategy.index:
+                comb_col.create_index([('grain', 1)] + self.strategy.index)
+            grains = sorted(comb_col.distinct('grain'), key=str)
+            self.log(f"Alocação paralela por {self.strategy.label}: {len(grains)} grãos em {n_workers} processos")
+            
+            results = {}
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+                futures = {
+                    pool.submit(allocate_partition, self.config, grain): idx
+                    for idx, grain in enumerate(grains)
+                }
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+                    self.progress = (len(results) / len(grains)) * 80 + 10  # 10-90%
+            
+            # Intercala as partições pela chave da estratégia, independente da ordem de término
+            results = [results[idx] for idx in sorted(results)]
+            for result in results:
+                for key in PARTITION_COUNTERS:
+                    self.stats[key] += result['stats'][key]
+            merged = heapq.merge(*(zip(result['keys'], result['rows']) for result in results),
+                                 key=lambda keyed: keyed[0])
+            rows = [row for key, row in merged]
+            
+            self.summarize_rows(rows)
+            return rows
+        except Exception as e:
+            self.log(f"Erro na alocação paralela: {str(e)}", "ERROR")
+            return []
+    
+    def allocate(self):
+        """Carrega os candidatos da fonte configurada e retorna as linhas alocadas"""
+        if self.config['source'] == 'combinations' and (self.config['parallel_workers'] or 1) > 1:
+            return self.allocate_parallel()
+        if self.config['source'] == 'orders':
+            destinations = self.load_candidates()
+            if destinations is None or not self.stats['total_combinations']:
+                return []
+            return self.process_allocations_indexed(destinations)
+        
+        combinations = self.load_combinations()
+        if combinations is None or not self.stats['total_combinations']:
+            return []
+        if self.config['source'] == 'columns':
+            columns = CombinationColumns.from_cursor(combinations)
+            self.log(f"{len(columns)} combinações em arrays: "
+                     f"{columns.nbytes() / max(len(columns), 1):.0f} bytes por combinação")
+            return self.process_allocations_columnar(columns)
+        return self.process_allocations(combinations)
+    
     def save_to_postgresql(self, rows):
         """Salva resultados no PostgreSQL"""
         try:
             cursor = self.pg_conn.cursor()
             
+            staging = f"{self.table_name}_staging"
+            
             self.log(f"Inserindo {len(rows)} registros no PostgreSQL...")
-            execute_values(cursor, '''
-            INSERT INTO provisioningsv2_best_scenario_distance (
-              destination_order,
-              origin_order,
-              buyer,
-              seller,
-              grain,
-              amount_allocated,
-              revenue,
-              cost,
-              freight,
-              tax_balance,
-              profit_total,
-              distance,
-              from_coords,
-              to_coords
-            ) VALUES %s;
-            ''', rows)
+            self.write_rows(cursor, staging, rows)
             
+            if self.config['keep_history']:
+                self.scenario_id = self.record_scenario(cursor, staging, len(rows))
+            
+            # Carga e troca na mesma transação: leitores veem o cenário anterior ou o novo, completo
+            self.swap_scenario_table(cursor)
             self.pg_conn.commit()
             self.log("Dados inseridos no PostgreSQL com sucesso")
-            return True
         except Exception as e:
+            self.pg_conn.rollback()
             self.log(f"Erro ao salvar no PostgreSQL: {str(e)}", "ERROR")
             return False
+        
+        if self.config['keep_history']:
+            self.apply_retention(cursor)
+        return True
+    
+    def record_scenario(self, cursor, source, row_count, destinations=None):
+        """
+        Registra a execução e copia as linhas de source para uma nova partição do histórico.
+        
+        Com destinations (provisionamento incremental), copia só as linhas desses destinos
+        e registra o último cenário da tabela como base; SCENARIO_ROWS_QUERY remonta o
+        cenário completo. Sem cenário base, a cópia é completa.
+        """
+        base_scenario_id = None
+        if destinations is not None:
+            cursor.execute(
+                "SELECT MAX(scenario_id) FROM provisioningsv2_scenarios WHERE table_name = %s",
+                (self.table_name,)
+            )
+            base_scenario_id, = cursor.fetchone()
+        if base_scenario_id is None:
+            destinations = None
+        
+        cursor.execute('''
+        INSERT INTO provisioningsv2_scenarios (
+          strategy, table_name, row_count, total_allocated, total_revenue, total_cost,
+          total_profit, total_freight, total_tax_balance, average_distance, grain_totals,
+          base_scenario_id, component_destinations
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING scenario_id;
+        ''', (
+            self.strategy_name,
+            self.table_name,
+            row_count,
+            self.stats['total_allocated'],
+            self.stats['total_revenue'],
+            self.stats['total_cost'],
+            self.stats['total_profit'],
+            self.stats['total_freight'],
+            self.stats['total_tax_balance'],
+            self.stats['average_distance'],
+            Json(self.stats['grain_totals']),
+            base_scenario_id,
+            list(destinations) if destinations is not None else None
+        ))
+        scenario_id, = cursor.fetchone()
+        
+        # A partição é preenchida antes de anexada, sem bloquear leitores do histórico;
+        # o CHECK dispensa a varredura de validação no ATTACH
+        partition = f"{HISTORY_TABLE}_{scenario_id}"
+        columns = ', '.join(('id',) + SCENARIO_COLUMNS)
+        cursor.execute(f"CREATE TABLE {partition} (LIKE {HISTORY_TABLE});")
+        cursor.execute(f"ALTER TABLE {partition} ADD CHECK (scenario_id = {scenario_id});")
+        if destinations is None:
+            cursor.execute(
+                f"INSERT INTO {partition} (scenario_id, {columns}) SELECT %s, {columns} FROM {source};",
+                (scenario_id,)
+            )
+        else:
+            cursor.execute(
+                f"INSERT INTO {partition} (scenario_id, {columns}) SELECT %s, {columns} FROM {source} "
+                f"WHERE destination_order = ANY(%s);",
+                (scenario_id, list(destinations))
+            )
+        cursor.execute(
+            f"ALTER TABLE {HISTORY_TABLE} ATTACH PARTITION {partition} FOR VALUES IN ({scenario_id});"
+        )
+        if base_scenario_id is None:
+            self.log(f"Cenário {scenario_id} registrado no histórico")
+        else:
+            self.log(f"Cenário {scenario_id} registrado no histórico: {len(destinations)} destinos "
+                     f"sobre o cenário {base_scenario_id}")
+        return scenario_id
+    
+    def apply_retention(self, cursor):
+        """
+        Remove do histórico os cenários mais antigos desta tabela além da retenção.
+        
+        Roda depois do commit do cenário novo: uma falha aqui só adia a limpeza para
+        a próxima execução e não desfaz o que já foi gravado. Cada partição é desanexada
+        com DETACH ... CONCURRENTLY (fora de transação), que não bloqueia as leituras do
+        histórico, e só então descartada; o DROP da tabela já solta não trava a tabela pai.
+        """
+        keep = self.config['scenario_retention']
+        if keep is None:
+            return True
+        
+        try:
+            # Cenários incrementais retidos mantêm a cadeia de cenários base de que dependem
+            cursor.execute('''
+            WITH RECURSIVE kept AS (
+              (SELECT scenario_id, base_scenario_id FROM provisioningsv2_scenarios
+               WHERE table_name = %s
+               ORDER BY scenario_id DESC
+               LIMIT %s)
+              UNION
+              SELECT s.scenario_id, s.base_scenario_id
+              FROM provisioningsv2_scenarios s JOIN kept k ON s.scenario_id = k.base_scenario_id
+            )
+            SELECT scenario_id FROM provisioningsv2_scenarios
+            WHERE table_name = %s AND scenario_id NOT IN (SELECT scenario_id FROM kept)
+            ORDER BY scenario_id;
+            ''', (self.table_name, keep, self.table_name))
+            expired = [scenario_id for scenario_id, in cursor.fetchall()]
+            self.pg_conn.commit()
+        except Exception as e:
+            self.pg_conn.rollback()
+            self.log(f"Retenção do histórico não aplicada: {str(e)}", "WARNING")
+            return False
+        
+        try:
+            self.pg_conn.autocommit = True
+            for scenario_id in expired:
+                partition = f"{HISTORY_TABLE}_{scenario_id}"
+                cursor.execute(
+                    "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(%s)",
+                    (partition,)
+                )
+                attached = cursor.fetchone()
+                if attached:
+                    # Um DETACH CONCURRENTLY interrompido deixa a partição pendente: FINALIZE o conclui
+                    mode = 'FINALIZE' if attached[0] else 'CONCURRENTLY'
+                    cursor.execute(f"ALTER TABLE {HISTORY_TABLE} DETACH PARTITION {partition} {mode};")
+                cursor.execute(f"DROP TABLE IF EXISTS {partition};")
+                cursor.execute("DELETE FROM provisioningsv2_scenarios WHERE scenario_id = %s", (scenario_id,))
+                self.log(f"Cenário {scenario_id} removido do histórico (retenção de {keep})")
+            return True
+        except Exception as e:
+            self.log(f"Retenção do histórico não aplicada: {str(e)}", "WARNING")
+            return False
+        finally:
+            self.pg_conn.autocommit = False
+    
+    def affected_component(self, cursor, destinations, origins):
+        """
+        Fecho (BFS) das ordens alteradas no grafo destino-origem, seguindo tanto as
+        combinações atuais quanto as alocações do cenário vigente. Fora desse
+        componente nenhuma alocação pode mudar.
+        """
+        comb_col = self.db['provisioningsv2Combinations']
+        comb_col.create_index([('destinationOrder', 1), ('originOrder', 1)])
+        comb_col.create_index([('originOrder', 1)])
+        
+        dests, origs = set(destinations), set(origins)
+        new_dests, new_origs = set(dests), set(origs)
+        while new_dests or new_origs:
+            found_dests, found_origs = set(), set()
+            if new_dests:
+                found_origs.update(map(str, comb_col.distinct(
+                    'originOrder', {'destinationOrder': {'$in': [ObjectId(d) for d in new_dests]}})))
+                cursor.execute(
+                    f"SELECT DISTINCT origin_order FROM {self.table_name} WHERE destination_order = ANY(%s)",
+                    (list(new_dests),)
+                )
+                found_origs.update(o for o, in cursor.fetchall())
+            if new_origs:
+                found_dests.update(map(str, comb_col.distinct(
+                    'destinationOrder', {'originOrder': {'$in': [ObjectId(o) for o in new_origs]}})))
+                cursor.execute(
+                    f"SELECT DISTINCT destination_order FROM {self.table_name} WHERE origin_order = ANY(%s)",
+                    (list(new_origs),)
+                )
+                found_dests.update(d for d, in cursor.fetchall())
+            
+            new_dests, new_origs = found_dests - dests, found_origs - origs
+            dests |= new_dests
+            origs |= new_origs
+        
+        return dests, origs
+    
+    def apply_component_rows(self, cursor, dests, rows):
+        """Aplica no cenário vigente o diff das linhas do componente: upserts e deletes por par"""
+        table = self.table_name
+        columns = ', '.join(SCENARIO_COLUMNS)
+        
+        cursor.execute(f'''
+        CREATE TEMP TABLE provisioning_component_rows ON COMMIT DROP AS
+        SELECT {columns} FROM {table} WITH NO DATA;
+        ''')
+        self.copy_rows(cursor, 'provisioning_component_rows', rows)
+        
+        # Todas as alocações que tocam o componente têm destino nele (fecho do BFS)
+        cursor.execute(f'''
+        DELETE FROM {table} t
+        WHERE t.destination_order = ANY(%s)
+          AND NOT EXISTS (
+            SELECT 1 FROM provisioning_component_rows n
+            WHERE n.destination_order = t.destination_order AND n.origin_order = t.origin_order
+          );
+        ''', (list(dests),))
+        deleted = cursor.rowcount
+        
+        # Pares existentes mantêm o id (e os ajustes ligados a ele); linhas iguais não são reescritas
+        updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in SCENARIO_COLUMNS[2:])
+        current = ', '.join(f"t.{c}" for c in SCENARIO_COLUMNS[2:])
+        excluded = ', '.join(f"EXCLUDED.{c}" for c in SCENARIO_COLUMNS[2:])
+        cursor.execute(f'''
+        INSERT INTO {table} AS t ({columns})
+        SELECT {columns} FROM provisioning_component_rows
+        ON CONFLICT (destination_order, origin_order) DO UPDATE SET {updates}
+        WHERE ({current}) IS DISTINCT FROM ({excluded});
+        ''')
+        upserted = cursor.rowcount
+        return upserted, deleted
+    
+    def load_scenario_stats(self, cursor):
+        """Recalcula as estatísticas do cenário vigente inteiro a partir da tabela"""
+        cursor.execute(f'''
+        SELECT grain, COUNT(*), SUM(amount_allocated), SUM(revenue), SUM(cost),
+               SUM(freight), SUM(tax_balance), SUM(profit_total), SUM(distance)
+        FROM {self.table_name}
+        GROUP BY grain;
+        ''')
+        totals = [0] * 8
+        grain_totals = {}
+        for grain, *values in cursor.fetchall():
+            values = [float(v or 0) for v in values]
+            totals = [t + v for t, v in zip(totals, values)]
+            grain_totals[grain] = values[1]
+        
+        count, allocated, revenue, cost, freight, tax_balance, profit, distance = totals
+        self.stats.update({
+            'total_allocated': allocated,
+            'total_revenue': revenue,
+            'total_cost': cost,
+            'total_profit': profit,
+            'total_freight': freight,
+            'total_tax_balance': tax_balance,
+            'average_distance': distance / count if count else 0
+        })
+        self.stats['grain_totals'] = grain_totals
+        return int(count)
+    
+    def allocate_component(self, match):
+        """Aloca só as combinações do filtro; None em caso de erro"""
+        combinations = self.load_combinations(match)
+        if combinations is None:
+            return None
+        return self.process_allocations(combinations) if self.stats['total_combinations'] else []
+    
+    def has_full_scenario(self, cursor):
+        """
+        Indica se a estratégia já publicou um cenário completo. A tabela do cenário é
+        criada vazia antes da troca, então só existir não basta: um provisionamento
+        completo interrompido não serve de base para o incremental.
+        """
+        cursor.execute("SELECT to_regclass(%s)", (self.table_name,))
+        if cursor.fetchone()[0] is None:
+            self.pg_conn.rollback()
+            return False
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {self.table_name});")
+        published = cursor.fetchone()[0]
+        self.pg_conn.rollback()
+        return published
+    
+    def resolve_pending_changes(self, started_at, destinations=None, origins=None):
+        """Marca as pendências consumidas como resolvidas nesta tabela; se falhar, ficam para a próxima execução"""
+        try:
+            resolved = resolve_pending_changes(self.db, self.table_name, started_at, destinations, origins)
+            self.log(f"{resolved} pendências de reprovisionamento resolvidas em {self.table_name}")
+        except Exception as e:
+            self.log(f"Pendências de reprovisionamento não removidas: {str(e)}", "WARNING")
+    
+    def run_incremental(self, destination_orders=None, origin_orders=None):
+        """
+        Reprovisiona apenas o componente das ordens adicionadas, canceladas ou alteradas.
+        Sem ordens informadas, usa as pendências acumuladas pelas sincronizações.
+        """
+        try:
+            self.telemetry.reset()
+            self.stats = self.new_stats()
+            started_at = datetime.utcnow()
+            
+            self.log(f"=== Iniciando provisionamento incremental por {self.label} ===")
+            
+            if not self.connect_mongodb() or not self.connect_postgresql():
+                self.status = "Erro"
+                return False
+            
+            if destination_orders is None and origin_orders is None:
+                pending = load_pending_changes(self.db, self.table_name)
+                if pending['full']:
+                    self.log("Há uma sincronização completa pendente: execute o provisionamento completo", "WARNING")
+                    self.status = "Erro"
+                    return False
+                destination_orders, origin_orders = pending['sales'], pending['purchases']
+            destination_orders = {str(d) for d in destination_orders or ()}
+            origin_orders = {str(o) for o in origin_orders or ()}
+            
+            cursor = self.pg_conn.cursor()
+            if not self.has_full_scenario(cursor):
+                self.log(f"{self.table_name} não tem cenário completo publicado: execute o provisionamento "
+                         f"completo por {self.label} antes do incremental", "ERROR")
+                self.status = "Erro"
+                return False
+            self.migrate_scenario_table(cursor)
+            self.pg_conn.commit()
+            
+            # Componente afetado
+            self.progress = 10
+            dests, origs = self.affected_component(cursor, destination_orders, origin_orders)
+            self.log(f"Componente afetado: {len(dests)} destinos e {len(origs)} origens")
+            
+            # Realocação restrita ao componente
+            self.progress = 20
+            rows = []
+            if dests:
+                rows = self.allocate_component({'destinationOrder': {'$in': [ObjectId(d) for d in dests]}})
+                if rows is None:
+                    self.status = "Erro"
+                    return False
+            
+            # Diff no cenário vigente, na mesma transação do registro no histórico
+            self.progress = 90
+            upserted, deleted = self.apply_component_rows(cursor, dests, rows)
+            self.stats['rows_upserted'] = upserted
+            self.stats['rows_deleted'] = deleted
+            row_count = self.load_scenario_stats(cursor)
+            if self.config['keep_history']:
+                self.scenario_id = self.record_scenario(cursor, self.table_name, row_count, dests)
+            self.pg_conn.commit()
+            if self.config['keep_history']:
+                self.apply_retention(cursor)
+            self.resolve_pending_changes(started_at, destination_orders, origin_orders)
+            
+            self.progress = 100
+            self.status = "Concluído"
+            self.log(f"=== Incremental concluído: {upserted} linhas gravadas, {deleted} removidas ===")
+            return True
+        except Exception as e:
+            self.status = "Erro"
+            if self.pg_conn:
+                self.pg_conn.rollback()
+            self.log(f"Erro no provisionamento incremental: {str(e)}", "ERROR")
+            self.log(traceback.format_exc(), "ERROR")
+            return False
+        finally:
+            if self.mongo_client:
+                self.mongo_client.close()
+            if self.pg_conn:
+                self.pg_conn.close()
+    
+    def write_rows(self, cursor, table, rows):
+        """Grava as linhas pelo método configurado"""
+        if self.config['pg_write_method'] == 'copy':
+            self.copy_rows(cursor, table, rows)
+        else:
+            self.insert_rows(cursor, table, rows)
+    
+    def insert_rows(self, cursor, table, rows):
+        """Insere as linhas com INSERT ... VALUES em lotes"""
+        execute_values(cursor, f'''
+        INSERT INTO {table} ({', '.join(SCENARIO_COLUMNS)}) VALUES %s;
+        ''', rows)
+    
+    def copy_rows(self, cursor, table, rows):
+        """Envia as linhas via COPY FROM STDIN em CSV, a partir de buffers em memória"""
+        sql = f"COPY {table} ({', '.join(SCENARIO_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+        chunk = self.config['copy_chunk_rows']
+        
+        for start in range(0, len(rows), chunk):
+            buffer = io.StringIO()
+            buffer.writelines(
+                ','.join(map(csv_field, row)) + '\n'
+                for row in rows[start:start + chunk]
+            )
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
     
     def run_provisioning(self):
         """Executa provisionamento completo"""
         try:
-            self.status = "Executando"
-            self.progress = 0
-            self.logs = []
-            self.stats = {
-                'total_combinations': 0,
-                'total_allocated': 0,
-                'total_revenue': 0,
-                'total_cost': 0,
-                'total_profit': 0,
-                'total_freight': 0,
-                'total_tax_balance': 0,
-                'average_distance': 0,
-                'grain_totals': {},
-                'processed_combinations': 0
-            }
-            
-            self.log("=== Iniciando provisionamento por distância mínima ===")
+            self.telemetry.reset()
+            self.stats = self.new_stats()
+            started_at = datetime.utcnow()
+            
+            self.log(f"=== Iniciando provisionamento por {self.label} ===")
             
             # Conectar aos bancos
             if not self.connect_mongodb():
@@ -324,21 +1333,18 @@ class ProvisioningMinDistance:
                 self.status = "Erro"
                 return False
             
+            # A partir daqui as pendências ficam guardadas até esta tabela resolvê-las
+            register_scenario_table(self.db, self.table_name)
+            
             # Preparar tabela PostgreSQL
             self.progress = 5
             if not self.prepare_postgresql_table():
                 self.status = "Erro"
                 return False
             
-            # Carregar combinações
+            # Carregar combinações e processar alocações
             self.progress = 10
-            comb_list = self.load_combinations()
-            if not comb_list:
-                self.status = "Erro"
-                return False
-            
-            # Processar alocações
-            rows = self.process_allocations(comb_list)
+            rows = self.allocate()
             if not rows:
                 self.status = "Erro"
                 return False
@@ -349,6 +1355,9 @@ class ProvisioningMinDistance:
                 self.status = "Erro"
                 return False
             
+            # O cenário completo cobre todas as alterações sincronizadas antes do início
+            self.resolve_pending_changes(started_at)
+            
             self.progress = 100
             self.status = "Concluído"
             self.log("=== Provisionamento concluído com sucesso ===")
@@ -381,3 +1390,16 @@ class ProvisioningMinDistance:
 # Instância global
 provisioning_min_distance = ProvisioningMinDistance()
 
+# Uma instância por estratégia: execuções simultâneas de estratégias diferentes não
+# compartilham estado, e a estratégia de uma execução em andamento nunca é trocada
+_strategy_instances = {provisioning_min_distance.config['strategy']: provisioning_min_distance}
+_instances_lock = threading.Lock()
+
+
+def get_provisioning_for_strategy(name):
+    """Retorna a instância global da estratégia, criando-a na primeira chamada"""
+    with _instances_lock:
+        if name not in _strategy_instances:
+            _strategy_instances[name] = ProvisioningMinDistance(strategy=name)
+        return _strategy_instances[name]
+
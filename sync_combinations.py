@@ -4,16 +4,33 @@
 Módulo de sincronização de combinações entre MongoDB e PostgreSQL
 """
 
-from pymongo import MongoClient, InsertOne
+from pymongo import MongoClient, InsertOne, UpdateOne, ReplaceOne, DeleteMany
 from bson import ObjectId
 import psycopg2
 from psycopg2.extras import execute_values
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime
+from distance_store import DistanceStore
+from job_telemetry import JobTelemetry
+import hashlib
+import heapq
+import multiprocessing
 import streamlit as st
+import threading
 import time
 import traceback
 
+# --- Conexão MongoDB ---
+MONGO_URI = (
+    "mongodb+srv://doadmin:5vk9a08N2tX3e64U@"
+    "foxdigital-e8bf0024.mongo.ondigitalocean.com/admin?"
+    "authSource=admin&replicaSet=foxdigital"
+)
+
 # --- Token Mapbox ---
 MAPBOX_TOKEN = "pk.your_mapbox_token_here"
 
@@ -23,6 +40,73 @@ GRAIN_NAMES = {
     ObjectId('5e349c053b0fd74ea91f148a'): 'sorgo'
 }
 
+# Parâmetros de frete e impostos por saca
+FREIGHT_PER_KM = 0.024
+MIN_FREIGHT = 1.50
+PIS_RATE = 0.0925
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Configurações da sincronização
+SYNC_CONFIG = {
+    'engine': 'numpy',                          # 'numpy' (vetorizado por grão) ou 'python' (par a par)
+    'sync_mode': 'full',                        # 'full' (apaga e regera) ou 'incremental' (só ordens alteradas)
+    'write_chunk_size': 5000,                   # operações por bulk_write
+    'operations_batch_size': 1000,              # documentos por lote do cursor de operações
+    # Poda de pares (None desativa): nunca são materializados nem gravados
+    'max_distance_km': None,                    # distância máxima da rota
+    'min_profit_per_bag': None,                 # lucro mínimo por saca
+    'top_k_origins': None,                      # apenas as K origens mais próximas de cada destino
+    # Estimativa por haversine × fator de sinuosidade, usada quando não há rota do Mapbox
+    'road_circuity_factor': 1.3,
+    # Geração paralela (modo completo): processos e partições por processo
+    'parallel_workers': None,                   # None ou 1 = serial
+    'shards_per_worker': 4,
+    'mapbox_base_url': 'https://api.mapbox.com',
+    'mapbox_max_workers': 4,                    # requisições simultâneas
+    'mapbox_requests_per_minute': 60,           # limite da Matrix API
+    'mapbox_matrix_size': 25,                   # coordenadas por requisição Matrix
+    'mapbox_timeout': 30,                       # segundos
+    # Cache local de distâncias (None para carregar o dicionário completo do MongoDB a cada execução)
+    'distance_cache_dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), '.distance_cache')
+}
+
+# Projeta no servidor apenas os campos usados de cada operação, já achatados em venda e compras
+OPERATIONS_PIPELINE = [
+    {'$sort': {'_id': -1}},
+    {'$project': {
+        '_id': 0,
+        'sale': {
+            '_id': '$destinationOrder._id',
+            'grain': '$destinationOrder.grain',
+            'bagPrice': '$destinationOrder.bagPrice',
+            'amount': '$destinationOrder.amount',
+            'hasPIS': {'$ifNull': ['$destinationOrder.hasPIS', False]},
+            'buyerName': '$destinationOrder.buyer.name',
+            # 'to' pode ser o endereço embutido ou apenas o seu _id
+            'to_id': {'$ifNull': ['$destinationOrder.to._id', '$destinationOrder.to']},
+            'to_coords': '$destinationOrder.to.location.coordinates',
+            'amountProvisionedOriginal': {
+                '$ifNull': ['$destinationOrder.amountProvisioned', '$destinationOrder.amount']
+            }
+        },
+        'purchases': {'$map': {
+            'input': {'$ifNull': ['$originOrders', []]},
+            'as': 'o',
+            'in': {
+                '_id': '$$o.order._id',
+                'grain': '$$o.order.grain',
+                'bagPrice': '$$o.order.bagPrice',
+                'amount': '$$o.order.amount',
+                'hasPIS': '$$o.order.hasPIS',
+                'sellerName': '$$o.order.seller.name',
+                'from_id': {'$ifNull': ['$$o.order.from._id', '$$o.order.from']},
+                'from_coords': '$$o.order.from.location.coordinates'
+            }
+        }}
+    }}
+]
+
 # Configurações do banco de dados
 DB_CONFIG = {
     'host': '24.199.75.66',
@@ -38,38 +122,267 @@ def prepare(val):
         return str(val)
     return val
 
+class RateLimiter:
+    """Limita a taxa de chamadas entre threads espaçando-as uniformemente"""
+    
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class SaleOrder:
+    """Venda (ordem de destino) de uma operação"""
+    __slots__ = ('id', 'grain', 'bag_price', 'amount', 'has_pis', 'buyer_name',
+                 'to_id', 'to_coords', 'amount_provisioned')
+    
+    def __init__(self, id, grain, bag_price, amount, has_pis, buyer_name,
+                 to_id, to_coords, amount_provisioned):
+        self.id = id
+        self.grain = grain
+        self.bag_price = bag_price
+        self.amount = amount
+        self.has_pis = has_pis
+        self.buyer_name = buyer_name
+        self.to_id = to_id
+        self.to_coords = to_coords
+        self.amount_provisioned = amount_provisioned
+    
+    @classmethod
+    def from_raw(cls, raw):
+        """Cria a venda a partir do registro projetado por OPERATIONS_PIPELINE"""
+        to_id = raw.get('to_id')
+        return cls(
+            raw.get('_id'), raw.get('grain'), raw.get('bagPrice'), raw.get('amount'),
+            raw.get('hasPIS'), raw.get('buyerName'),
+            None if isinstance(to_id, dict) else to_id,
+            raw.get('to_coords'), raw.get('amountProvisionedOriginal')
+        )
+    
+    def values(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+class PurchaseOrder:
+    """Compra (ordem de origem) de uma operação"""
+    __slots__ = ('id', 'grain', 'bag_price', 'amount', 'has_pis', 'seller_name',
+                 'from_id', 'from_coords')
+    
+    def __init__(self, id, grain, bag_price, amount, has_pis, seller_name, from_id, from_coords):
+        self.id = id
+        self.grain = grain
+        self.bag_price = bag_price
+        self.amount = amount
+        self.has_pis = has_pis
+        self.seller_name = seller_name
+        self.from_id = from_id
+        self.from_coords = from_coords
+    
+    @classmethod
+    def from_raw(cls, raw):
+        """Cria a compra a partir do registro projetado por OPERATIONS_PIPELINE"""
+        from_id = raw.get('from_id')
+        return cls(
+            raw.get('_id'), raw.get('grain'), raw.get('bagPrice'), raw.get('amount'),
+            raw.get('hasPIS'), raw.get('sellerName'),
+            None if isinstance(from_id, dict) else from_id,
+            raw.get('from_coords')
+        )
+    
+    def values(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+def order_hash(record):
+    """Hash do conteúdo de uma venda/compra, usado para detectar alterações entre sincronizações"""
+    return hashlib.sha1(repr(record.values()).encode('utf-8')).hexdigest()
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """Distância em linha reta (km) entre coordenadas; aceita escalares ou arrays"""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def pair_metrics(sale, pur, dist):
+    """Calcula frete, impostos, custo efetivo, lucro e alocação máxima de um par"""
+    freight = max(dist * FREIGHT_PER_KM, MIN_FREIGHT)
+    oricredit = pur.bag_price * PIS_RATE if pur.has_pis else 0
+    dentax = sale.bag_price * PIS_RATE if sale.has_pis else 0
+    efforig = pur.bag_price + freight + (dentax - oricredit)
+    profit = sale.bag_price - efforig
+    allocated = min(sale.amount_provisioned, pur.amount)
+    return freight, oricredit, dentax, efforig, profit, allocated
+
+def build_combination_doc(sale, pur, dist, freight, oricredit, dentax, efforig, profit, allocated,
+                          estimated=False):
+    """Monta o documento de provisioningsv2Combinations de um par"""
+    return {
+        'destinationOrder': ObjectId(sale.id),
+        'originOrder': ObjectId(pur.id),
+        'seller': pur.seller_name,
+        'buyer': sale.buyer_name,
+        'destinationPrice': sale.bag_price,
+        'originPrice': pur.bag_price,
+        'amountDestination': sale.amount,
+        'amountOrigin': pur.amount,
+        'freightCost': freight,
+        'originCredit': oricredit,
+        'destinationTax': dentax,
+        'effectiveOriginCost': efforig,
+        'profit': profit,
+        'grain': ObjectId(sale.grain),
+        'distance': dist,
+        'distanceEstimated': estimated,
+        'from_coords': pur.from_coords,
+        'to_coords': sale.to_coords,
+        'amountProvisionedOriginal': sale.amount_provisioned,
+        'amountAllocatedOriginal': allocated,
+        'paymentDaysAfterDelivery': None,
+        'financialCost': 0
+    }
+
+def generate_partition(config, buckets, distances, estimated_pairs, unresolved_pairs, dry_run=False):
+    """Gera e grava as combinações de uma partição dentro de um processo do pool"""
+    worker = SyncCombinations(**config)
+    worker.estimated_pairs = estimated_pairs
+    worker.unresolved_pairs = unresolved_pairs
+    if not dry_run and not worker.connect_mongodb():
+        raise RuntimeError("Falha ao conectar ao MongoDB no processo de geração")
+    
+    try:
+        buyer_distances = {}
+        
+        def docs():
+            for doc in worker.iter_docs(buckets, distances):
+                worker.track_buyer_distance(buyer_distances, doc)
+                yield doc
+        
+        if dry_run:
+            count = sum(1 for _ in docs())
+        else:
+            comb_col = worker.db['provisioningsv2Combinations']
+            count = worker.write_chunked(comb_col, (InsertOne(doc) for doc in docs()))['inserted']
+        
+        return {
+            'count': count,
+            'pairs_visited': worker.stats['pairs_visited'],
+            'buyer_distances': buyer_distances
+        }
+    finally:
+        if worker.mongo_client:
+            worker.mongo_client.close()
+
+PENDING_KINDS = ['pending_sale', 'pending_purchase', 'pending_full']
+
+def register_scenario_table(db, table_name):
+    """Inclui table_name entre as tabelas que precisam resolver cada pendência antes da remoção"""
+    db['provisioningsv2CombinationsSyncState'].update_one(
+        {'_id': f"scenario_table:{table_name}"},
+        {'$set': {'kind': 'scenario_table', 'table': table_name}},
+        upsert=True
+    )
+
+def load_pending_changes(db, table_name):
+    """Ordens pendentes de reprovisionamento na tabela de cenário table_name"""
+    pending = {'sales': set(), 'purchases': set(), 'full': False}
+    state_col = db['provisioningsv2CombinationsSyncState']
+    query = {'kind': {'$in': PENDING_KINDS}, 'resolvedBy': {'$ne': table_name}}
+    for st_doc in state_col.find(query, {'kind': 1, 'order': 1}):
+        if st_doc['kind'] == 'pending_full':
+            pending['full'] = True
+        else:
+            pending['sales' if st_doc['kind'] == 'pending_sale' else 'purchases'].add(st_doc['order'])
+    return pending
+
+def resolve_pending_changes(db, table_name, before, sales=None, purchases=None):
+    """
+    Marca como resolvidas na tabela table_name as pendências registradas antes de
+    before. Sem ordens informadas, marca todas (provisionamento completo); pendências
+    gravadas a partir de before, por uma sincronização concorrente, continuam para o
+    próximo provisionamento. Cada tabela de cenário resolve só as suas: a pendência é
+    removida quando todas as tabelas registradas a resolveram.
+    """
+    state_col = db['provisioningsv2CombinationsSyncState']
+    query = {'updatedAt': {'$lt': before}, 'resolvedBy': {'$ne': table_name}}
+    if sales is None and purchases is None:
+        query['kind'] = {'$in': PENDING_KINDS}
+    else:
+        query['$or'] = [
+            {'kind': 'pending_sale', 'order': {'$in': [str(o) for o in sales or ()]}},
+            {'kind': 'pending_purchase', 'order': {'$in': [str(o) for o in purchases or ()]}}
+        ]
+    resolved = state_col.update_many(query, {'$addToSet': {'resolvedBy': table_name}}).modified_count
+    
+    tables = [st_doc['table'] for st_doc in state_col.find({'kind': 'scenario_table'}, {'table': 1})]
+    state_col.delete_many({'kind': {'$in': PENDING_KINDS}, 'resolvedBy': {'$all': tables}})
+    return resolved
+
 class SyncCombinations:
-    def __init__(self):
+    def __init__(self, **config):
+        self.config = {**SYNC_CONFIG, **config}
         self.mongo_client = None
         self.db = None
         self.pg_conn = None
-        self.status = "Não iniciado"
-        self.progress = 0
-        self.logs = []
+        self.telemetry = JobTelemetry()
+        self.address_coords = {}
+        self.estimated_pairs = set()
+        self.unresolved_pairs = set()  # pares sem distância nem coordenadas: não geram combinação
         self.stats = {
             'total_operations': 0,
             'total_sales': 0,
             'total_purchases': 0,
+            'duplicate_sales': 0,
+            'duplicate_purchases': 0,
             'total_combinations': 0,
             'distances_calculated': 0,
+            'distances_estimated': 0,
+            'distances_unresolved': 0,
+            'distance_requests_skipped': 0,
+            'pairs_visited': 0,
+            'pairs_pruned': 0,
+            'orders_changed': 0,
+            'orders_removed': 0,
             'buyer_distances': {}
         }
+        self.status = "Não iniciado"
+    
+    @property
+    def status(self):
+        return self.telemetry.status
+    
+    @status.setter
+    def status(self, value):
+        self.telemetry.set_status(value, self.stats)
+    
+    @property
+    def progress(self):
+        return self.telemetry.progress
+    
+    @progress.setter
+    def progress(self, value):
+        self.telemetry.set_progress(value, self.stats)
+    
+    @property
+    def logs(self):
+        return self.telemetry.logs()
+    
+    def report_progress(self, value):
+        """Progresso de um laço, publicado no máximo a cada intervalo mínimo da telemetria"""
+        return self.telemetry.report_progress(value, self.stats)
     
     def log(self, message, level="INFO"):
         """Adiciona log com timestamp"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] [{level}] {message}"
-        self.logs.append(log_entry)
-        print(log_entry)
+        self.telemetry.log(message, level)
     
     def connect_mongodb(self):
         """Conecta ao MongoDB"""
         try:
-            self.mongo_client = MongoClient(
-                "mongodb+srv://doadmin:5vk9a08N2tX3e64U@"
-                "foxdigital-e8bf0024.mongo.ondigitalocean.com/admin?"
-                "authSource=admin&replicaSet=foxdigital"
-            )
+            self.mongo_client = MongoClient(MONGO_URI)
             self.db = self.mongo_client['fox']
             self.log("Conectado ao MongoDB com sucesso")
             return True
@@ -101,51 +414,38 @@ class SyncCombinations:
     def load_operations(self):
         """Carrega operações de venda e compra"""
         try:
-            provs = list(self.db.provisioningsv2Operations.find().sort('_id', -1))
-            self.stats['total_operations'] = len(provs)
-            self.log(f"Encontradas {len(provs)} operações")
-            
-            sales, purchases = [], []
-            
-            for prov in provs:
-                d = prov.get('destinationOrder', {})
-                raw_to = d.get('to', {})
-                to_id = raw_to.get('_id') if isinstance(raw_to, dict) else raw_to
-                to_coords = raw_to.get('location', {}).get('coordinates')
-                amount_provisioned = d.get('amountProvisioned', d.get('amount'))
-                
-                sales.append({
-                    '_id': d.get('_id'),
-                    'grain': d.get('grain'),
-                    'bagPrice': d.get('bagPrice'),
-                    'amount': d.get('amount'),
-                    'hasPIS': d.get('hasPIS', False),
-                    'buyerName': (d.get('buyer') or {}).get('name'),
-                    'to_id': to_id,
-                    'to_coords': to_coords,
-                    'amountProvisionedOriginal': amount_provisioned
-                })
+            cursor = self.db.provisioningsv2Operations.aggregate(
+                OPERATIONS_PIPELINE,
+                allowDiskUse=True,
+                batchSize=self.config['operations_batch_size']
+            )
+            
+            sales, purchases = {}, {}
+            n_operations = n_origin_orders = 0
+            
+            # A mesma ordem pode aparecer em várias operações; mantém a da operação mais recente
+            for prov in cursor:
+                n_operations += 1
+                sale = SaleOrder.from_raw(prov.get('sale', {}))
+                sales.setdefault(sale.id, sale)
                 
-                for o in prov.get('originOrders', []):
-                    ord_ = o.get('order', {})
-                    raw_from = ord_.get('from', {})
-                    from_id = raw_from.get('_id') if isinstance(raw_from, dict) else raw_from
-                    from_coords = raw_from.get('location', {}).get('coordinates')
-                    
-                    purchases.append({
-                        '_id': ord_.get('_id'),
-                        'grain': ord_.get('grain'),
-                        'bagPrice': ord_.get('bagPrice'),
-                        'amount': ord_.get('amount'),
-                        'hasPIS': ord_.get('hasPIS'),
-                        'sellerName': (ord_.get('seller') or {}).get('name'),
-                        'from_id': from_id,
-                        'from_coords': from_coords
-                    })
+                for raw_pur in prov.get('purchases', []):
+                    n_origin_orders += 1
+                    if raw_pur.get('_id') not in purchases:
+                        purchases[raw_pur.get('_id')] = PurchaseOrder.from_raw(raw_pur)
+            
+            sales = list(sales.values())
+            purchases = list(purchases.values())
+            self.stats['total_operations'] = n_operations
+            self.stats['duplicate_sales'] = n_operations - len(sales)
+            self.stats['duplicate_purchases'] = n_origin_orders - len(purchases)
+            self.log(f"Encontradas {n_operations} operações")
             
             self.stats['total_sales'] = len(sales)
             self.stats['total_purchases'] = len(purchases)
-            self.log(f"Separados {len(sales)} vendas e {len(purchases)} compras")
+            self.log(f"Separados {len(sales)} vendas e {len(purchases)} compras distintas "
+                     f"({self.stats['duplicate_sales']} vendas e "
+                     f"{self.stats['duplicate_purchases']} compras repetidas descartadas)")
             
             return sales, purchases
         except Exception as e:
@@ -155,128 +455,490 @@ class SyncCombinations:
     def load_distances(self):
         """Carrega distâncias existentes"""
         try:
+            cache_dir = self.config['distance_cache_dir']
+            if cache_dir:
+                store = DistanceStore(cache_dir)
+                store.load()
+                updated = store.refresh(self.db.distances)
+                self.log(f"{len(store)} distâncias no cache local ({updated} atualizadas do MongoDB)")
+                return store
+            
             distcursor = self.db.distances.find({}, {'from':1,'to':1,'inKm':1})
             distances_map = {(d['from'], d['to']): d.get('inKm',0) for d in distcursor}
             self.log(f"{len(distances_map)} distâncias carregadas na memória")
             return distances_map
         except Exception as e:
+            # Sem distâncias a execução consultaria o Mapbox para todos os pares: interrompe
             self.log(f"Erro ao carregar distâncias: {str(e)}", "ERROR")
+            raise
+    
+    def load_address_coords(self, sales, purchases):
+        """Carrega em uma única consulta as coordenadas (lon, lat) de todos os endereços usados"""
+        try:
+            address_ids = {sale.to_id for sale in sales} | {pur.from_id for pur in purchases}
+            address_ids.discard(None)
+            
+            coords = {}
+            cursor = self.db.addresses.find(
+                {'_id': {'$in': list(address_ids)}},
+                {'farmLocation.coordinates': 1}
+            )
+            for addr in cursor:
+                try:
+                    lon, lat = addr['farmLocation']['coordinates']
+                except (KeyError, TypeError, ValueError):
+                    continue
+                coords[addr['_id']] = (lon, lat)
+            
+            self.address_coords = coords
+            self.log(f"Coordenadas carregadas para {len(coords)} de {len(address_ids)} endereços")
+            return True
+        except Exception as e:
+            self.log(f"Erro ao carregar coordenadas: {str(e)}", "ERROR")
+            return False
+    
+    def missing_pairs(self, buckets, distances_map):
+        """Lista os pares (origem, destino) do mesmo grão ainda sem distância"""
+        missing = set()
+        for grain, grain_sales, grain_purchases in buckets:
+            from_ids = {pur.from_id for pur in grain_purchases}
+            to_ids = {sale.to_id for sale in grain_sales}
+            for frm in from_ids:
+                for to in to_ids:
+                    if distances_map.get((frm, to), 0) == 0:
+                        missing.add((frm, to))
+        return missing
+    
+    def matrix_batches(self, missing, coords):
+        """Divide os pares ausentes em blocos origens × destinos da Matrix API"""
+        size = self.config['mapbox_matrix_size']
+        by_origin = {}
+        for frm, to in missing:
+            if frm in coords and to in coords:
+                by_origin.setdefault(frm, set()).add(to)
+        
+        origins = sorted(by_origin, key=str)
+        n_src = max(1, min(len(origins), size // 2))
+        n_dst = size - n_src
+        
+        for i in range(0, len(origins), n_src):
+            src = origins[i:i + n_src]
+            dests = sorted(set().union(*(by_origin[o] for o in src)), key=str)
+            for j in range(0, len(dests), n_dst):
+                dst = dests[j:j + n_dst]
+                pairs = [(o, d) for o in src for d in dst if d in by_origin[o]]
+                if pairs:
+                    yield src, dst, pairs
+    
+    def fetch_matrix(self, session, limiter, src, dst, coords):
+        """Consulta a Matrix API do Mapbox para um bloco, retornando km por par"""
+        points = src + dst
+        path = ';'.join(f"{coords[p][0]},{coords[p][1]}" for p in points)
+        url = f"{self.config['mapbox_base_url']}/directions-matrix/v1/mapbox/driving/{path}"
+        params = {
+            'sources': ';'.join(str(i) for i in range(len(src))),
+            'destinations': ';'.join(str(i) for i in range(len(src), len(points))),
+            'annotations': 'distance',
+            'access_token': MAPBOX_TOKEN
+        }
+        
+        limiter.wait()
+        r = session.get(url, params=params, timeout=self.config['mapbox_timeout'])
+        r.raise_for_status()
+        matrix = r.json()['distances']
+        
+        return {
+            (o, d): matrix[i][j] / 1000
+            for i, o in enumerate(src)
+            for j, d in enumerate(dst)
+            if matrix[i][j] is not None
+        }
+    
+    def endpoint_coords(self, buckets):
+        """Coordenadas (lon, lat) de cada endereço: fazenda cadastrada ou localização da ordem"""
+        coords = {}
+        for grain, grain_sales, grain_purchases in buckets:
+            for sale in grain_sales:
+                if sale.to_coords and len(sale.to_coords) == 2:
+                    coords.setdefault(sale.to_id, tuple(sale.to_coords))
+            for pur in grain_purchases:
+                if pur.from_coords and len(pur.from_coords) == 2:
+                    coords.setdefault(pur.from_id, tuple(pur.from_coords))
+        coords.update(self.address_coords)
+        return coords
+    
+    def estimate_distances(self, pairs, coords):
+        """Estimativa vetorizada da distância rodoviária: haversine × fator de sinuosidade"""
+        pairs = [pair for pair in pairs if pair[0] in coords and pair[1] in coords]
+        if not pairs:
             return {}
+        frm = np.array([coords[a] for a, _ in pairs], dtype=float)
+        to = np.array([coords[b] for _, b in pairs], dtype=float)
+        km = haversine_km(frm[:, 0], frm[:, 1], to[:, 0], to[:, 1])
+        return dict(zip(pairs, km.tolist()))
     
-    def get_mapbox_distance(self, frm, to):
-        """Consulta distância via Mapbox se necessário"""
+    def resolve_missing_distances(self, buckets, distances_map):
+        """Resolve em paralelo as distâncias ausentes via Mapbox antes de gerar as combinações"""
         try:
-            fa = self.db.addresses.find_one({'_id':frm}, {'farmLocation.coordinates':1})
-            ta = self.db.addresses.find_one({'_id':to}, {'farmLocation.coordinates':1})
+            missing = self.missing_pairs(buckets, distances_map)
+            if not missing:
+                self.log("Nenhuma distância ausente")
+                return True
+            
+            factor = self.config['road_circuity_factor']
+            straight = self.estimate_distances(missing, self.endpoint_coords(buckets))
             
-            if not fa or not ta:
-                return 0
+            # A linha reta é limite inferior da rota: acima do máximo, o par seria podado de qualquer forma
+            to_request = missing
+            max_dist = self.config['max_distance_km']
+            if max_dist is not None:
+                to_request = {pair for pair in missing if straight.get(pair, 0) <= max_dist}
+                self.stats['distance_requests_skipped'] = len(missing) - len(to_request)
             
-            lon1, lat1 = fa['farmLocation']['coordinates']
-            lon2, lat2 = ta['farmLocation']['coordinates']
+            coords = self.address_coords
+            batches = list(self.matrix_batches(to_request, coords))
+            self.log(f"Resolvendo {len(to_request)} distâncias ausentes em {len(batches)} requisições Mapbox "
+                     f"({len(missing) - len(to_request)} descartadas pela linha reta)")
             
-            url = f"https://api.mapbox.com/directions/v5/mapbox/driving/{lon1},{lat1};{lon2},{lat2}?access_token={MAPBOX_TOKEN}&overview=false"
-            r = requests.get(url)
+            workers = self.config['mapbox_max_workers']
+            limiter = RateLimiter(self.config['mapbox_requests_per_minute'])
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+            session.mount('http://', HTTPAdapter(pool_maxsize=workers))
             
-            if r.status_code != 200:
-                return 0
+            resolved = {}
+            with session, ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(self.fetch_matrix, session, limiter, src, dst, coords): pairs
+                    for src, dst, pairs in batches
+                }
+                for future in as_completed(futures):
+                    try:
+                        km_by_pair = future.result()
+                    except Exception as e:
+                        self.log(f"Erro ao consultar Mapbox: {str(e)}", "ERROR")
+                        continue
+                    for pair in futures[future]:
+                        if pair in km_by_pair:
+                            resolved[pair] = km_by_pair[pair]
             
-            try:
-                km = r.json()['routes'][0]['distance'] / 1000
-            except:
-                km = 0
+            # Sem rota: usa a estimativa (sinalizada e não persistida); sem coordenadas, o par
+            # fica sem distância e é descartado na geração (nunca vira uma rota de 0 km)
+            for pair in missing:
+                if pair in resolved:
+                    distances_map[pair] = resolved[pair]
+                elif pair in straight:
+                    distances_map[pair] = straight[pair] * factor
+                    self.estimated_pairs.add(pair)
+                else:
+                    self.unresolved_pairs.add(pair)
             
-            # Salva no MongoDB
-            self.db.distances.update_one(
-                {'from':frm,'to':to},
-                {'$set':{'inKm':km,'isActive':True,'updatedAt':datetime.utcnow()},
-                 '$setOnInsert':{'createdAt':datetime.utcnow(),'__v':0}},
-                upsert=True
-            )
+            if resolved:
+                now = datetime.utcnow()
+                self.db.distances.bulk_write([
+                    UpdateOne(
+                        {'from': frm, 'to': to},
+                        {'$set': {'inKm': km, 'isActive': True},
+                         '$currentDate': {'updatedAt': True},
+                         '$setOnInsert': {'createdAt': now, '__v': 0}},
+                        upsert=True
+                    )
+                    for (frm, to), km in resolved.items()
+                ], ordered=False)
             
-            self.stats['distances_calculated'] += 1
-            return km
+            self.stats['distances_calculated'] += len(resolved)
+            self.stats['distances_estimated'] = len(self.estimated_pairs)
+            self.stats['distances_unresolved'] = len(self.unresolved_pairs)
+            self.log(f"{len(resolved)} distâncias resolvidas, {len(self.estimated_pairs)} estimadas")
+            if self.unresolved_pairs:
+                self.log(f"{len(self.unresolved_pairs)} pares sem distância nem coordenadas não gerarão combinações",
+                         "WARNING")
+            return True
         except Exception as e:
-            self.log(f"Erro ao consultar Mapbox: {str(e)}", "ERROR")
-            return 0
+            self.log(f"Erro ao resolver distâncias: {str(e)}", "ERROR")
+            return False
+    
+    def group_by_grain(self, sales, purchases):
+        """Agrupa vendas e compras por grão, retornando apenas grãos com pares possíveis"""
+        purchases_by_grain = {}
+        for pur in purchases:
+            purchases_by_grain.setdefault(pur.grain, []).append(pur)
+        
+        sales_by_grain = {}
+        for sale in sales:
+            if sale.grain in purchases_by_grain:
+                sales_by_grain.setdefault(sale.grain, []).append(sale)
+        
+        return [
+            (grain, grain_sales, purchases_by_grain[grain])
+            for grain, grain_sales in sales_by_grain.items()
+        ]
+    
+    def iter_buckets(self, buckets):
+        """Percorre os grupos por grão, atualizando o progresso ao fim de cada grão"""
+        total_pairs = sum(len(s) * len(p) for _, s, p in buckets)
+        processed = 0
+        
+        for bucket in buckets:
+            yield bucket
+            
+            processed += len(bucket[1]) * len(bucket[2])
+            self.stats['pairs_visited'] = processed
+            self.report_progress((processed / total_pairs) * 100 if total_pairs else 100)
+    
+    def iter_pairs(self, buckets):
+        """Percorre apenas pares venda/compra do mesmo grão"""
+        for grain, grain_sales, grain_purchases in self.iter_buckets(buckets):
+            for sale in grain_sales:
+                for pur in grain_purchases:
+                    yield sale, pur
+    
+    def pair_distance(self, pur, sale, distances_map):
+        """Retorna a distância do par (0 quando não resolvida)"""
+        return distances_map.get((pur.from_id, sale.to_id), 0)
+    
+    def distance_matrix(self, grain_sales, grain_purchases, distances_map):
+        """Matriz vendas × compras de distâncias (0 quando não resolvida)"""
+        if isinstance(distances_map, DistanceStore):
+            return distances_map.lookup_matrix(
+                [pur.from_id for pur in grain_purchases],
+                [sale.to_id for sale in grain_sales]
+            )
+        return np.array([
+            [self.pair_distance(pur, sale, distances_map) for pur in grain_purchases]
+            for sale in grain_sales
+        ], dtype=float)
+    
+    def unresolved_mask(self, grain_sales, grain_purchases):
+        """Matriz vendas × compras dos pares sem distância resolvida (None se não houver)"""
+        if not self.unresolved_pairs:
+            return None
+        rows, cols = {}, {}
+        for i, sale in enumerate(grain_sales):
+            rows.setdefault(sale.to_id, []).append(i)
+        for j, pur in enumerate(grain_purchases):
+            cols.setdefault(pur.from_id, []).append(j)
+        
+        mask = np.zeros((len(grain_sales), len(grain_purchases)), dtype=bool)
+        for frm, to in self.unresolved_pairs:
+            if frm in cols and to in rows:
+                mask[np.ix_(rows[to], cols[frm])] = True
+        return mask if mask.any() else None
+    
+    def iter_docs_python(self, buckets, distances_map):
+        """Gera documentos de combinação calculando par a par"""
+        max_dist = self.config['max_distance_km']
+        min_profit = self.config['min_profit_per_bag']
+        top_k = self.config['top_k_origins']
+        
+        for grain, grain_sales, grain_purchases in self.iter_buckets(buckets):
+            for sale in grain_sales:
+                kept = []
+                for pur in grain_purchases:
+                    if (pur.from_id, sale.to_id) in self.unresolved_pairs:
+                        continue
+                    dist = self.pair_distance(pur, sale, distances_map)
+                    if max_dist is not None and dist > max_dist:
+                        continue
+                    metrics = pair_metrics(sale, pur, dist)
+                    if min_profit is not None and metrics[4] < min_profit:
+                        continue
+                    kept.append((dist, len(kept), pur, metrics))
+                
+                if top_k is not None and len(kept) > top_k:
+                    # Heap das K menores distâncias; o índice desempata e preserva a ordem original
+                    kept = sorted(heapq.nsmallest(top_k, kept, key=lambda c: c[:2]), key=lambda c: c[1])
+                
+                for dist, _, pur, metrics in kept:
+                    estimated = (pur.from_id, sale.to_id) in self.estimated_pairs
+                    yield build_combination_doc(sale, pur, dist, *metrics, estimated=estimated)
+    
+    def iter_docs_numpy(self, buckets, distances_map):
+        """Gera documentos de combinação com os cálculos vetorizados por grão"""
+        max_dist = self.config['max_distance_km']
+        min_profit = self.config['min_profit_per_bag']
+        top_k = self.config['top_k_origins']
+        pruning = max_dist is not None or min_profit is not None or top_k is not None
+        
+        for grain, grain_sales, grain_purchases in self.iter_buckets(buckets):
+            dist = self.distance_matrix(grain_sales, grain_purchases, distances_map)
+            unresolved = self.unresolved_mask(grain_sales, grain_purchases)
+            
+            sale_price = np.array([s.bag_price for s in grain_sales], dtype=float)
+            sale_pis = np.array([bool(s.has_pis) for s in grain_sales])
+            pur_price = np.array([p.bag_price for p in grain_purchases], dtype=float)
+            pur_pis = np.array([bool(p.has_pis) for p in grain_purchases])
+            
+            # Mesma ordem de operações do cálculo par a par, para resultados idênticos
+            freight = np.maximum(dist * FREIGHT_PER_KM, MIN_FREIGHT)
+            oricredit = np.where(pur_pis, pur_price * PIS_RATE, 0.0)
+            dentax = np.where(sale_pis, sale_price * PIS_RATE, 0.0)
+            efforig = pur_price[None, :] + freight + (dentax[:, None] - oricredit[None, :])
+            profit = sale_price[:, None] - efforig
+            
+            keep = None
+            if pruning or unresolved is not None:
+                keep = np.ones(dist.shape, dtype=bool) if unresolved is None else ~unresolved
+                if max_dist is not None:
+                    keep &= dist <= max_dist
+                if min_profit is not None:
+                    keep &= profit >= min_profit
+                if top_k is not None and top_k < dist.shape[1]:
+                    # Ordenação estável: empates resolvidos pela ordem original, como no heap
+                    ranked = np.argsort(np.where(keep, dist, np.inf), axis=1, kind='stable')[:, :top_k]
+                    nearest = np.zeros(dist.shape, dtype=bool)
+                    np.put_along_axis(nearest, ranked, True, axis=1)
+                    keep &= nearest
+            
+            oricredit_row = [c if p.has_pis else 0 for c, p in zip(oricredit.tolist(), grain_purchases)]
+            for i, sale in enumerate(grain_sales):
+                dentax_i = dentax[i].item() if sale.has_pis else 0
+                maxprov = sale.amount_provisioned
+                rows = zip(grain_purchases, dist[i].tolist(), freight[i].tolist(),
+                           oricredit_row, efforig[i].tolist(), profit[i].tolist())
+                if keep is not None:
+                    rows = (row for row, k in zip(rows, keep[i].tolist()) if k)
+                for pur, d, fr, oc, eo, pr in rows:
+                    allocated = min(maxprov, pur.amount)
+                    estimated = (pur.from_id, sale.to_id) in self.estimated_pairs
+                    yield build_combination_doc(sale, pur, d, fr, oc, dentax_i, eo, pr, allocated, estimated)
+    
+    def iter_docs(self, buckets, distances_map):
+        """Gera documentos de combinação com o motor configurado"""
+        if self.config['engine'] == 'numpy':
+            return self.iter_docs_numpy(buckets, distances_map)
+        return self.iter_docs_python(buckets, distances_map)
+    
+    def write_chunked(self, collection, ops):
+        """Grava operações em blocos de bulk_write não ordenados à medida que são produzidas"""
+        chunk_size = self.config['write_chunk_size']
+        totals = {'inserted': 0, 'upserted': 0, 'modified': 0, 'deleted': 0}
+        chunk = []
+        n_chunks = 0
+        
+        def flush():
+            nonlocal n_chunks
+            start = time.perf_counter()
+            res = collection.bulk_write(chunk, ordered=False)
+            elapsed = time.perf_counter() - start
+            n_chunks += 1
+            totals['inserted'] += res.inserted_count
+            totals['upserted'] += res.upserted_count
+            totals['modified'] += res.modified_count
+            totals['deleted'] += res.deleted_count
+            self.log(f"Bloco {n_chunks}: {len(chunk)} operações gravadas em {elapsed:.2f}s")
+            chunk.clear()
+        
+        for op in ops:
+            chunk.append(op)
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+        
+        return totals
+    
+    def track_buyer_distance(self, buyer_distances, doc):
+        """Acumula distância total e número de rotas por comprador sem guardar cada rota"""
+        entry = buyer_distances.setdefault(doc['buyer'] or 'Desconhecido', {'total_km': 0, 'routes': 0})
+        entry['total_km'] += doc['distance']
+        entry['routes'] += 1
+    
+    def shard_buckets(self, buckets, n_workers):
+        """Divide os grupos por grão em partições de vendas (destinos) com volume de pares parecido"""
+        total_pairs = sum(len(s) * len(p) for _, s, p in buckets)
+        target = max(1, total_pairs // (n_workers * self.config['shards_per_worker']))
+        
+        shards = []
+        for grain, grain_sales, grain_purchases in buckets:
+            step = max(1, target // max(1, len(grain_purchases)))
+            for i in range(0, len(grain_sales), step):
+                shards.append((grain, grain_sales[i:i + step], grain_purchases))
+        return shards
+    
+    def shard_distances(self, shard, distances_map):
+        """Recorta as distâncias (e estimativas) usadas por uma partição"""
+        grain, grain_sales, grain_purchases = shard
+        from_ids = list({pur.from_id for pur in grain_purchases})
+        to_ids = list({sale.to_id for sale in grain_sales})
+        
+        if isinstance(distances_map, DistanceStore):
+            matrix = distances_map.lookup_matrix(from_ids, to_ids).tolist()
+            distances = {(frm, to): matrix[i][j] for j, frm in enumerate(from_ids) for i, to in enumerate(to_ids)}
+        else:
+            distances = {(frm, to): distances_map.get((frm, to), 0) for frm in from_ids for to in to_ids}
+        
+        estimated = {pair for pair in distances if pair in self.estimated_pairs}
+        unresolved = {pair for pair in distances if pair in self.unresolved_pairs}
+        return distances, estimated, unresolved
+    
+    def generate_parallel(self, buckets, distances_map, dry_run=False):
+        """Gera as combinações em um ProcessPoolExecutor; cada processo grava seus próprios blocos"""
+        n_workers = self.config['parallel_workers']
+        shards = self.shard_buckets(buckets, n_workers)
+        total_pairs = sum(len(s) * len(p) for _, s, p in shards)
+        self.log(f"Geração paralela: {len(shards)} partições em {n_workers} processos")
+        
+        results = {}
+        processed = 0
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+            futures = {}
+            for idx, shard in enumerate(shards):
+                distances, estimated, unresolved = self.shard_distances(shard, distances_map)
+                future = pool.submit(generate_partition, self.config, [shard], distances, estimated,
+                                     unresolved, dry_run)
+                futures[future] = idx
+            
+            for future in as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+                processed += result['pairs_visited']
+                self.stats['pairs_visited'] = processed
+                self.progress = (processed / total_pairs) * 100 if total_pairs else 100
+        
+        # Junta os resultados na ordem das partições, independente da ordem de término dos processos
+        results = [results[idx] for idx in sorted(results)]
+        buyer_distances = {}
+        for result in results:
+            for buyer, entry in result['buyer_distances'].items():
+                total = buyer_distances.setdefault(buyer, {'total_km': 0, 'routes': 0})
+                total['total_km'] += entry['total_km']
+                total['routes'] += entry['routes']
+        
+        return sum(r['count'] for r in results), buyer_distances
     
     def generate_combinations(self, sales, purchases, distances_map):
-        """Gera e persiste combinações"""
+        """Gera e persiste combinações em blocos, sem acumular todos os documentos em memória"""
         try:
             comb_col = self.db['provisioningsv2Combinations']
             buyer_distances = {}
-            ops = []
-            count = 0
             
-            total_pairs = len(sales) * len(purchases)
-            processed = 0
+            buckets = self.group_by_grain(sales, purchases)
+            self.log(f"{len(buckets)} grãos com pares possíveis "
+                     f"({sum(len(s) * len(p) for _, s, p in buckets)} de {len(sales) * len(purchases)} pares)")
             
-            for sale in sales:
-                for pur in purchases:
-                    processed += 1
-                    self.progress = (processed / total_pairs) * 100
-                    
-                    if sale['grain'] != pur['grain']:
-                        continue
-                    
-                    frm, to = pur['from_id'], sale['to_id']
-                    dist = distances_map.get((frm, to), 0)
-                    
-                    if dist == 0:
-                        dist = self.get_mapbox_distance(frm, to)
-                        distances_map[(frm, to)] = dist
-                    
-                    freight = max(dist * 0.024, 1.50)
-                    oricredit = pur['bagPrice'] * 0.0925 if pur['hasPIS'] else 0
-                    dentax = sale['bagPrice'] * 0.0925 if sale['hasPIS'] else 0
-                    efforig = pur['bagPrice'] + freight + (dentax - oricredit)
-                    profit = sale['bagPrice'] - efforig
-                    maxprov = sale['amountProvisionedOriginal']
-                    allocated = min(maxprov, pur['amount'])
-                    
-                    buyer = sale['buyerName'] or 'Desconhecido'
-                    buyer_distances.setdefault(buyer, []).append(dist)
-                    
-                    doc = {
-                        'destinationOrder': ObjectId(sale['_id']),
-                        'originOrder': ObjectId(pur['_id']),
-                        'seller': pur['sellerName'],
-                        'buyer': sale['buyerName'],
-                        'destinationPrice': sale['bagPrice'],
-                        'originPrice': pur['bagPrice'],
-                        'amountDestination': sale['amount'],
-                        'amountOrigin': pur['amount'],
-                        'freightCost': freight,
-                        'originCredit': oricredit,
-                        'destinationTax': dentax,
-                        'effectiveOriginCost': efforig,
-                        'profit': profit,
-                        'grain': ObjectId(sale['grain']),
-                        'distance': dist,
-                        'from_coords': pur.get('from_coords'),
-                        'to_coords': sale.get('to_coords'),
-                        'amountProvisionedOriginal': maxprov,
-                        'amountAllocatedOriginal': allocated,
-                        'paymentDaysAfterDelivery': None,
-                        'financialCost': 0
-                    }
-                    ops.append(InsertOne(doc))
-                    count += 1
+            def insert_ops():
+                for doc in self.iter_docs(buckets, distances_map):
+                    self.track_buyer_distance(buyer_distances, doc)
+                    yield InsertOne(doc)
+            
+            if (self.config['parallel_workers'] or 1) > 1:
+                count, buyer_distances = self.generate_parallel(buckets, distances_map)
+            else:
+                count = self.write_chunked(comb_col, insert_ops())['inserted']
             
             self.stats['total_combinations'] = count
+            self.stats['pairs_pruned'] = self.stats['pairs_visited'] - count
             self.stats['buyer_distances'] = buyer_distances
-            self.log(f"Geradas {count} combinações")
+            self.log(f"Geradas {count} combinações ({self.stats['pairs_pruned']} pares podados)")
             
-            if ops:
-                self.log(f"Inserindo {len(ops)} combinações (bulk_write)")
-                res = comb_col.bulk_write(ops)
-                self.log(f"Bulk write concluído: {res.inserted_count} inseridos")
-                
+            if count:
                 # Log distâncias médias por comprador
                 self.log("=== Distância média por comprador ===")
-                for buyer, dists in buyer_distances.items():
-                    avg = sum(dists)/len(dists) if dists else 0
-                    self.log(f"  {buyer}: {avg:.2f} km em {len(dists)} rotas")
+                for buyer, entry in buyer_distances.items():
+                    avg = entry['total_km'] / entry['routes'] if entry['routes'] else 0
+                    self.log(f"  {buyer}: {avg:.2f} km em {entry['routes']} rotas")
             else:
                 self.log("Nenhuma combinação para inserir", "WARNING")
             
@@ -285,18 +947,179 @@ class SyncCombinations:
             self.log(f"Erro ao gerar combinações: {str(e)}", "ERROR")
             return False
     
+    def load_sync_state(self):
+        """Carrega os hashes das vendas e compras da última sincronização"""
+        prev_sales, prev_purchases = {}, {}
+        state_col = self.db['provisioningsv2CombinationsSyncState']
+        for st_doc in state_col.find({'kind': {'$in': ['sale', 'purchase']}}, {'kind': 1, 'order': 1, 'hash': 1}):
+            target = prev_sales if st_doc['kind'] == 'sale' else prev_purchases
+            target[st_doc['order']] = st_doc['hash']
+        return prev_sales, prev_purchases
+    
+    def save_sync_state(self, changed_sales, changed_purchases, removed_sales, removed_purchases, full=False):
+        """Registra os hashes atuais das ordens alteradas e remove os das ordens excluídas"""
+        state_col = self.db['provisioningsv2CombinationsSyncState']
+        now = datetime.utcnow()
+        ops = [DeleteMany({'kind': {'$in': ['sale', 'purchase']}})] if full else []
+        
+        for kind, changed in (('sale', changed_sales), ('purchase', changed_purchases)):
+            for order_id, h in changed.items():
+                ops.append(ReplaceOne(
+                    {'_id': f"{kind}:{order_id}"},
+                    {'kind': kind, 'order': order_id, 'hash': h, 'updatedAt': now},
+                    upsert=True
+                ))
+        if removed_sales:
+            ops.append(DeleteMany({'kind': 'sale', 'order': {'$in': list(removed_sales)}}))
+        if removed_purchases:
+            ops.append(DeleteMany({'kind': 'purchase', 'order': {'$in': list(removed_purchases)}}))
+        
+        if ops:
+            state_col.bulk_write(ops, ordered=True)
+    
+    def save_pending_changes(self, sales, purchases, full=False):
+        """
+        Acumula as ordens a reprovisionar no estado da sincronização. As pendências
+        sobrevivem a novas sincronizações e reinícios e só são removidas depois que
+        todas as tabelas de cenário as resolveram; regravar uma pendência a reabre em
+        todas. full marca que todas as combinações foram regeradas e o próximo
+        provisionamento de cada tabela deve ser completo.
+        """
+        state_col = self.db['provisioningsv2CombinationsSyncState']
+        now = datetime.utcnow()
+        ops = []
+        for kind, orders in (('pending_sale', sales), ('pending_purchase', purchases)):
+            for order_id in orders:
+                ops.append(ReplaceOne(
+                    {'_id': f"{kind}:{order_id}"},
+                    {'kind': kind, 'order': str(order_id), 'updatedAt': now},
+                    upsert=True
+                ))
+        if full:
+            ops.append(ReplaceOne({'_id': 'pending_full'}, {'kind': 'pending_full', 'updatedAt': now}, upsert=True))
+        
+        if ops:
+            state_col.bulk_write(ops, ordered=False)
+    
+    def plan_incremental(self, sales, purchases):
+        """Detecta ordens adicionadas, alteradas ou removidas e monta os grupos de pares afetados"""
+        sale_hashes = {sale.id: order_hash(sale) for sale in sales}
+        purchase_hashes = {pur.id: order_hash(pur) for pur in purchases}
+        prev_sales, prev_purchases = self.load_sync_state()
+        
+        changed_sales = {i: h for i, h in sale_hashes.items() if prev_sales.get(i) != h}
+        changed_purchases = {i: h for i, h in purchase_hashes.items() if prev_purchases.get(i) != h}
+        removed_sales = set(prev_sales) - set(sale_hashes)
+        removed_purchases = set(prev_purchases) - set(purchase_hashes)
+        
+        # Com top-K, uma compra alterada ou removida pode mudar as K origens de qualquer venda
+        if self.config['top_k_origins'] is not None and (changed_purchases or removed_purchases):
+            changed_sales = sale_hashes
+        
+        # Vendas alteradas × todas as compras, e vendas inalteradas × compras alteradas
+        buckets = (
+            self.group_by_grain([s for s in sales if s.id in changed_sales], purchases) +
+            self.group_by_grain([s for s in sales if s.id not in changed_sales],
+                                [p for p in purchases if p.id in changed_purchases])
+        )
+        
+        changes = {
+            'changed_sales': changed_sales,
+            'changed_purchases': changed_purchases,
+            'removed_sales': removed_sales,
+            'removed_purchases': removed_purchases,
+            'bootstrap': not prev_sales and not prev_purchases
+        }
+        self.stats['orders_changed'] = len(changed_sales) + len(changed_purchases)
+        self.stats['orders_removed'] = len(removed_sales) + len(removed_purchases)
+        self.log(f"Incremental: {len(changed_sales)} vendas e {len(changed_purchases)} compras alteradas, "
+                 f"{len(removed_sales)} vendas e {len(removed_purchases)} compras removidas")
+        return buckets, changes
+    
+    def apply_incremental(self, buckets, changes, distances_map):
+        """Regrava apenas as combinações das ordens alteradas e remove as das ordens excluídas"""
+        try:
+            comb_col = self.db['provisioningsv2Combinations']
+            comb_col.create_index([('destinationOrder', 1), ('originOrder', 1)])
+            comb_col.create_index([('originOrder', 1)])
+            
+            run_id = ObjectId()
+            buyer_distances = {}
+            
+            def upsert_ops():
+                for doc in self.iter_docs(buckets, distances_map):
+                    doc['syncRun'] = run_id
+                    self.track_buyer_distance(buyer_distances, doc)
+                    yield ReplaceOne(
+                        {'destinationOrder': doc['destinationOrder'], 'originOrder': doc['originOrder']},
+                        doc, upsert=True
+                    )
+            
+            totals = self.write_chunked(comb_col, upsert_ops())
+            count = sum(entry['routes'] for entry in buyer_distances.values())
+            self.stats['pairs_pruned'] = self.stats['pairs_visited'] - count
+            self.stats['buyer_distances'] = buyer_distances
+            
+            changed_sales = [ObjectId(i) for i in changes['changed_sales']]
+            changed_purchases = [ObjectId(i) for i in changes['changed_purchases']]
+            removed_sales = [ObjectId(i) for i in changes['removed_sales']]
+            removed_purchases = [ObjectId(i) for i in changes['removed_purchases']]
+            
+            # Pares das ordens alteradas que não foram regerados nesta execução ficaram obsoletos
+            ops = []
+            if changed_sales:
+                ops.append(DeleteMany({'destinationOrder': {'$in': changed_sales}, 'syncRun': {'$ne': run_id}}))
+            if changed_purchases:
+                ops.append(DeleteMany({'originOrder': {'$in': changed_purchases}, 'syncRun': {'$ne': run_id}}))
+            if removed_sales:
+                ops.append(DeleteMany({'destinationOrder': {'$in': removed_sales}}))
+            if removed_purchases:
+                ops.append(DeleteMany({'originOrder': {'$in': removed_purchases}}))
+            if changes['bootstrap']:
+                # Sem estado anterior: descarta combinações de ordens que não existem mais
+                ops.append(DeleteMany({'$or': [
+                    {'destinationOrder': {'$nin': changed_sales}},
+                    {'originOrder': {'$nin': changed_purchases}}
+                ]}))
+            
+            deleted = comb_col.bulk_write(ops, ordered=True).deleted_count if ops else 0
+            self.log(f"Incremental concluído: {totals['upserted']} inseridos, "
+                     f"{totals['modified']} atualizados, {deleted} removidos")
+            
+            self.stats['total_combinations'] = count
+            self.save_sync_state(changes['changed_sales'], changes['changed_purchases'],
+                                 changes['removed_sales'], changes['removed_purchases'])
+            self.save_pending_changes(
+                set(changes['changed_sales']) | set(changes['removed_sales']),
+                set(changes['changed_purchases']) | set(changes['removed_purchases']),
+                full=changes['bootstrap']
+            )
+            return True
+        except Exception as e:
+            self.log(f"Erro na sincronização incremental: {str(e)}", "ERROR")
+            return False
+    
     def run_sync(self):
         """Executa sincronização completa"""
         try:
-            self.status = "Executando"
-            self.progress = 0
-            self.logs = []
+            self.telemetry.reset()
+            self.estimated_pairs = set()
+            self.unresolved_pairs = set()
             self.stats = {
                 'total_operations': 0,
                 'total_sales': 0,
                 'total_purchases': 0,
+                'duplicate_sales': 0,
+                'duplicate_purchases': 0,
                 'total_combinations': 0,
                 'distances_calculated': 0,
+                'distances_estimated': 0,
+                'distances_unresolved': 0,
+                'distance_requests_skipped': 0,
+                'pairs_visited': 0,
+                'pairs_pruned': 0,
+                'orders_changed': 0,
+                'orders_removed': 0,
                 'buyer_distances': {}
             }
             
@@ -311,9 +1134,11 @@ class SyncCombinations:
                 self.status = "Erro"
                 return False
             
+            incremental = self.config['sync_mode'] == 'incremental'
+            
             # Limpar combinações antigas
             self.progress = 10
-            if not self.clear_old_combinations():
+            if not incremental and not self.clear_old_combinations():
                 self.status = "Erro"
                 return False
             
@@ -324,16 +1149,45 @@ class SyncCombinations:
                 self.status = "Erro"
                 return False
             
+            # Carregar coordenadas dos endereços
+            self.progress = 25
+            if not self.load_address_coords(sales, purchases):
+                self.status = "Erro"
+                return False
+            
             # Carregar distâncias
             self.progress = 30
             distances_map = self.load_distances()
             
-            # Gerar combinações
-            self.progress = 40
-            if not self.generate_combinations(sales, purchases, distances_map):
+            # Definir os pares a (re)gerar
+            if incremental:
+                buckets, changes = self.plan_incremental(sales, purchases)
+            else:
+                buckets = self.group_by_grain(sales, purchases)
+            
+            # Resolver distâncias ausentes
+            self.progress = 35
+            if not self.resolve_missing_distances(buckets, distances_map):
                 self.status = "Erro"
                 return False
             
+            # Gerar combinações
+            self.progress = 40
+            if incremental:
+                if not self.apply_incremental(buckets, changes, distances_map):
+                    self.status = "Erro"
+                    return False
+            else:
+                if not self.generate_combinations(sales, purchases, distances_map):
+                    self.status = "Erro"
+                    return False
+                self.save_sync_state(
+                    {sale.id: order_hash(sale) for sale in sales},
+                    {pur.id: order_hash(pur) for pur in purchases},
+                    set(), set(), full=True
+                )
+                self.save_pending_changes((), (), full=True)
+            
             self.progress = 100
             self.status = "Concluído"
             self.log("=== Sincronização concluída com sucesso ===")
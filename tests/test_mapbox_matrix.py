@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resolução de distâncias pela Matrix API contra um servidor HTTP local no lugar do Mapbox
+"""
+
+from datetime import datetime, timezone
+import json
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+
+from sync_combinations import SyncCombinations, SaleOrder, PurchaseOrder, haversine_km
+
+GRAIN = ObjectId('5e349bed3b0fd74ea91f1488')
+
+
+class MatrixHandler(BaseHTTPRequestHandler):
+    """Responde como a Matrix API: distância em metros = |Δlon| × 100 km"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.server.requests.append(url)
+        if self.server.fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        path = unquote(url.path.rsplit('/', 1)[1])
+        points = [tuple(map(float, p.split(','))) for p in path.split(';')]
+        query = parse_qs(url.query)
+        sources = [int(i) for i in query['sources'][0].split(';')]
+        destinations = [int(i) for i in query['destinations'][0].split(';')]
+        body = json.dumps({'distances': [
+            [abs(points[s][0] - points[d][0]) * 100000 for d in destinations]
+            for s in sources
+        ]}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RecordedUpdate:
+    """No lugar de UpdateOne: guarda o filtro, a atualização e o upsert recebidos"""
+
+    def __init__(self, filter, update, upsert=False):
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+
+class RecordingCollection:
+    """Coleção que aplica os upserts de bulk_write a documentos em memória"""
+
+    def __init__(self):
+        self.calls = 0
+        self.docs = {}
+
+    def bulk_write(self, ops, ordered=True):
+        self.calls += 1
+        for op in ops:
+            key = (op.filter['from'], op.filter['to'])
+            if key not in self.docs:
+                if not op.upsert:
+                    continue
+                self.docs[key] = {**op.filter, **op.update.get('$setOnInsert', {})}
+            self.docs[key].update(op.update.get('$set', {}))
+            for field in op.update.get('$currentDate', {}):
+                self.docs[key][field] = datetime.now(timezone.utc)
+
+
+class RecordingDb:
+    def __init__(self):
+        self.distances = RecordingCollection()
+
+
+class MapboxMatrixTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MatrixHandler)
+        cls.server.requests = []
+        cls.server.fail = False
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.fail = False
+
+        self.origins = [ObjectId() for _ in range(3)]
+        self.dests = [ObjectId() for _ in range(4)]
+        self.coords = {addr: (-50.0 - 0.1 * i, -15.0) for i, addr in enumerate(self.origins)}
+        self.coords.update({addr: (-49.0 - 0.1 * i, -16.0) for i, addr in enumerate(self.dests)})
+
+        sales = [SaleOrder(ObjectId(), GRAIN, 70.0, 1000, False, 'Comprador', to_id, list(self.coords[to_id]), 1000)
+                 for to_id in self.dests]
+        purchases = [PurchaseOrder(ObjectId(), GRAIN, 50.0, 1000, False, 'Vendedor', from_id,
+                                   list(self.coords[from_id]))
+                     for from_id in self.origins]
+
+        self.sync = SyncCombinations(
+            mapbox_base_url=f"http://127.0.0.1:{self.server.server_address[1]}",
+            mapbox_matrix_size=4,
+            mapbox_requests_per_minute=None,
+            max_distance_km=None
+        )
+        self.sync.db = RecordingDb()
+        patcher = mock.patch('sync_combinations.UpdateOne', RecordedUpdate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sync.address_coords = dict(self.coords)
+        self.buckets = self.sync.group_by_grain(sales, purchases)
+        self.pairs = {(o, d) for o in self.origins for d in self.dests}
+
+    def test_batched_sources_destinations_request(self):
+        distances_map = {}
+        self.assertTrue(self.sync.resolve_missing_distances(self.buckets, distances_map))
+
+        # 4 coordenadas por requisição: 2 origens × 2 destinos, cobrindo os 12 pares em 4 requisições
+        self.assertEqual(len(self.server.requests), 4)
+        for url in self.server.requests:
+            query = parse_qs(url.query)
+            self.assertIn(query['sources'], (['0;1'], ['0']))
+            n_src = len(query['sources'][0].split(';'))
+            self.assertEqual(query['destinations'][0].split(';'), [str(n_src + i) for i in range(2)])
+            self.assertEqual(query['annotations'], ['distance'])
+            self.assertIn('/directions-matrix/v1/mapbox/driving/', url.path)
+
+        for o, d in self.pairs:
+            self.assertAlmostEqual(distances_map[(o, d)], abs(self.coords[o][0] - self.coords[d][0]) * 100)
+        self.assertEqual(self.sync.estimated_pairs, set())
+        self.assertEqual(self.sync.stats['distances_calculated'], 12)
+
+    def test_resolved_pairs_written_with_bulk_write(self):
+        distances_map = {}
+        self.sync.resolve_missing_distances(self.buckets, distances_map)
+
+        stored = self.sync.db.distances.docs
+        self.assertEqual(self.sync.db.distances.calls, 1)
+        self.assertEqual(set(stored), self.pairs)
+        for pair, doc in stored.items():
+            self.assertEqual(doc['inKm'], distances_map[pair])
+            self.assertTrue(doc['isActive'])
+            self.assertIn('updatedAt', doc)
+
+    def test_http_error_falls_back_to_flagged_estimate(self):
+        self.server.fail = True
+        distances_map = {}
+        self.assertTrue(self.sync.resolve_missing_distances(self.buckets, distances_map))
+
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.sync.db.distances.calls, 0)
+        self.assertEqual(self.sync.estimated_pairs, self.pairs)
+        self.assertEqual(self.sync.stats['distances_estimated'], 12)
+
+        factor = self.sync.config['road_circuity_factor']
+        for o, d in self.pairs:
+            (lon1, lat1), (lon2, lat2) = self.coords[o], self.coords[d]
+            self.assertAlmostEqual(distances_map[(o, d)], float(haversine_km(lon1, lat1, lon2, lat2)) * factor)
+
+        # As combinações geradas carregam a sinalização de estimativa
+        docs = list(self.sync.iter_docs(self.buckets, distances_map))
+        self.assertEqual(len(docs), 12)
+        self.assertTrue(all(doc['distanceEstimated'] for doc in docs))
+
+
+if __name__ == '__main__':
+    unittest.main()